@@ -0,0 +1,157 @@
+import os
+from random import Random
+
+from bitboard import BitBoard, plane_bits
+from game import Game, piece_indices, piece_labels
+from solver import Solver, TranspositionTable, cell_of, killer_pieces, threats
+from tablebase import TablebaseFile
+
+# computer players: choose_move returns the cell (pos_x, pos_y) to place the selected piece on (None in the
+# selection stage) and the label of the piece to give to the opponent (None if the placement ends the game)
+
+
+def position_of(game: Game) -> (int, int, int):
+    # read from the board itself for games on a BitBoard (as in ai_worker and arena), built from the cells otherwise
+    board = game.board
+    if not isinstance(board, BitBoard):
+        board = BitBoard.from_cells(board.to_cells())
+    return board.occupied, board.planes, game.remaining
+
+
+def pieces_in(mask: int) -> list[int]:
+    return [p for p in range(16) if mask >> p & 1]
+
+
+book_paths = ["opening_book.qtb", "endgame.qtb"]    # built with tablebase.py
+
+
+def load_books(paths: list[str] = None) -> list[TablebaseFile]:
+    return [TablebaseFile(path) for path in (book_paths if paths is None else paths) if os.path.exists(path)]
+
+
+class RandomPlayer:
+    def __init__(self, seed=None):
+        self.__random = Random(seed)
+
+    @property
+    def random(self):
+        return self.__random
+
+    def choose_move(self, game: Game) -> (tuple, str):
+        occupied, planes, remaining = position_of(game)
+        label = piece_labels[self.__random.choice(pieces_in(remaining))] if remaining else None
+        if game.stage == 1:
+            return None, label
+        cell = self.__random.choice([c for c in range(16) if not occupied >> c & 1])
+        return (cell // 4, cell % 4), label
+
+
+class GreedyPlayer:
+    # wins when it can, and never hands over a piece that lets the opponent win right away if it can avoid it
+    def __init__(self, seed=None):
+        self.__random = Random(seed)
+
+    @property
+    def random(self):
+        return self.__random
+
+    def choose_piece(self, occupied: int, planes: int, remaining: int):
+        if not remaining:
+            return None
+        safe = remaining & ~killer_pieces(occupied, planes)
+        return piece_labels[self.__random.choice(pieces_in(safe if safe else remaining))]
+
+    def choose_move(self, game: Game) -> (tuple, str):
+        occupied, planes, remaining = position_of(game)
+        if game.stage == 1:
+            return None, self.choose_piece(occupied, planes, remaining)
+
+        piece = piece_indices[game.last_selected_piece.code]
+        for cell_bit, killers in threats(occupied, planes):
+            if killers >> piece & 1:
+                cell = cell_of(cell_bit)
+                return (cell // 4, cell % 4), None
+
+        empty_cells = [c for c in range(16) if not occupied >> c & 1]
+        self.__random.shuffle(empty_cells)
+        best = None
+        for cell in empty_cells:    # prefer the placements that leave at least one safe piece to give
+            new_occupied, new_planes = occupied | 1 << cell, planes | plane_bits[piece][cell]
+            if not remaining or remaining & ~killer_pieces(new_occupied, new_planes):
+                best = cell, new_occupied, new_planes
+                break
+        if best is None:
+            cell = empty_cells[0]
+            best = cell, occupied | 1 << cell, planes | plane_bits[piece][cell]
+        cell, new_occupied, new_planes = best
+        return (cell // 4, cell % 4), self.choose_piece(new_occupied, new_planes, remaining)
+
+
+class SearchPlayer:
+    # proven opening book and endgame tablebase moves first, then the solver with a time budget per move (searching
+    # the stored move first when its value is only a best effort), falling back to the stored move or the greedy
+    # choice when the search finds nothing better
+    def __init__(self, time_limit: float = 2.0, table_size: int = 1 << 18, seed=None, books: list = None):
+        self.__time_limit = time_limit
+        self.__solver = Solver(TranspositionTable(table_size))
+        self.__greedy = GreedyPlayer(seed)
+        self.__books = load_books() if books is None else books
+
+    @property
+    def time_limit(self):
+        return self.__time_limit
+
+    def lookup(self, cells: list[int], piece: int):
+        # the first stored entry, preferring a proven one
+        found = None
+        for book in self.__books:
+            entry = book.lookup(cells, piece)
+            if entry is not None and entry[3]:
+                return entry
+            if found is None:
+                found = entry
+        return found
+
+    def book_move(self, game: Game):
+        # (move, proven, hint): the stored move, whether its value was proven, and the same move for
+        # Solver.solve_position; None if the position is not stored
+        cells = game.board.to_cells()
+        if game.stage == 2:
+            entry = self.lookup(cells, piece_indices[game.last_selected_piece.code])
+            if entry is None or entry[1] is None:
+                return None
+            _, cell, next_piece, complete = entry
+            move = (cell // 4, cell % 4), None if next_piece is None else piece_labels[next_piece]
+            return move, complete, (cell, next_piece)
+
+        # selection: give the piece with the worst stored value for the opponent, if all of them are stored
+        best_value, best_piece, complete = 2, None, True
+        for piece in pieces_in(game.remaining):
+            entry = self.lookup(cells, piece)
+            if entry is None:
+                return None
+            complete = complete and entry[3]
+            if entry[0] < best_value:
+                best_value, best_piece = entry[0], piece
+        if best_piece is None:
+            return None
+        return (None, piece_labels[best_piece]), complete, best_piece
+
+    def choose_move(self, game: Game) -> (tuple, str):
+        book = self.book_move(game) if self.__books else None
+        if book is not None and book[1]:   # proven: nothing to search
+            return book[0]
+        # a move stored with a best-effort value was searched with a larger budget than a move gets here: it is
+        # searched first, and played if the search finds nothing better
+        hint = None if book is None else book[2]
+        result = self.__solver.solve(game, time_limit=self.__time_limit, hint=hint)
+        if not result.complete and result.value <= 0:
+            return book[0] if book is not None else self.__greedy.choose_move(game)
+        return result.cell, result.piece
+
+
+difficulties = {
+    "easy": RandomPlayer,
+    "medium": GreedyPlayer,
+    "hard": SearchPlayer,
+}
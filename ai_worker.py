@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from ai import difficulties
+from bitboard import BitBoard
+from game import Game
+
+# Worker processes of the computer opponent. They are spawned, never forked from the bot, which runs an event loop and
+# threads by the time the first one starts; spawning imports the bot's main module again as "__mp_main__", which only
+# defines the bot there: the token and the saved state are read when it actually starts.
+
+# one player per difficulty for each worker process, so that the transposition table survives between moves
+_players = {}
+
+
+def compute_move(game_data: bytes, player_1: int, player_2: int, difficulty: str = "medium") -> (tuple, str):
+    # entry point for executors: the game travels in its binary form
+    if difficulty not in _players:
+        _players[difficulty] = difficulties[difficulty]()
+    game = Game.from_bytes(game_data, player_1, player_2, board_type=BitBoard)
+    return _players[difficulty].choose_move(game)
+
+
+def start_pool(workers: int = None) -> ProcessPoolExecutor:
+    # one core is left to the bot unless workers is given
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
@@ -0,0 +1,167 @@
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+from itertools import combinations
+from math import log
+from random import Random
+from time import perf_counter
+
+import ai
+import elo
+from bitboard import BitBoard
+from game import Game
+
+# Self-play arena: every pair of strategies plays the requested number of games, split into batches that run in a
+# process pool. Each batch gets its own seed, derived from the base seed, so runs are reproducible whatever the
+# number of workers.
+# A strategy is an ai difficulty ("easy", "medium", "hard") or "module:Class" for any class with choose_move(game)
+
+
+def make_player(name: str, seed: int, time_limit: float):
+    if name == "hard":
+        return ai.SearchPlayer(time_limit=time_limit, seed=seed, books=[])
+    if name in ai.difficulties:
+        return ai.difficulties[name](seed=seed)
+    module_name, class_name = name.split(":")
+    return getattr(import_module(module_name), class_name)()
+
+
+def play_game(players: dict, first_player: int) -> int:
+    # returns the final state of the game: 1 or 2 for the winner, 3 for a draw
+    game = Game(1, 2, first_player, board_type=BitBoard)
+    while True:
+        cell, label = players[game.turn].choose_move(game)
+        if game.stage == 2:
+            victory_by, _ = game.place_stage(*cell)
+            if victory_by > 0:
+                return game.state
+            if victory_by < 0:      # illegal placement: the player loses
+                return 3 - game.turn
+            if game.is_board_full():
+                return 3
+            game.change_stage()
+        if game.select_stage(label) != 1:   # illegal selection: the player loses
+            return 3 - game.turn
+        game.change_stage()
+        game.next_turn()
+
+
+def play_batch(name_a: str, name_b: str, games: int, seed: int, time_limit: float) -> list[tuple[str, str, float]]:
+    # worker entry point: (player, opponent, score of player) for every game, starting players alternating
+    rng = Random(seed)
+    player_a = make_player(name_a, rng.randrange(1 << 32), time_limit)
+    player_b = make_player(name_b, rng.randrange(1 << 32), time_limit)
+    results = []
+    for i in range(games):
+        players = {1: player_a, 2: player_b} if i % 2 == 0 else {1: player_b, 2: player_a}
+        state = play_game(players, first_player=1)
+        if state == 3:
+            score = 0.5
+        else:
+            score = 1.0 if players[state] is player_a else 0.0
+        results.append((name_a, name_b, score))
+    return results
+
+
+def elo_ratings(results: list[tuple[str, str, float]], initial: int = 1000, iterations: int = 1000,
+                tolerance: float = 1e-6) -> dict[str, int]:
+    # Elo ratings fitted to the total score of each pair, a draw counting as half a win, so they do not depend on the
+    # order the games were played in: the expected scores come from the bot's elo.get_winning_probability, and the
+    # ratings move (Newton steps, all at once) until they match the actual scores. Each pair also gets one virtual
+    # draw, which keeps the rating of a strategy that won or lost all its games finite
+    scores = defaultdict(float)     # (player, opponent) -> score of player
+    games = defaultdict(int)        # (player, opponent) -> games between them
+    for name_a, name_b, score in results:
+        scores[(name_a, name_b)] += score
+        scores[(name_b, name_a)] += 1 - score
+        games[(name_a, name_b)] += 1
+        games[(name_b, name_a)] += 1
+    opponents = defaultdict(list)
+    for (name, opponent) in list(games):
+        scores[(name, opponent)] += 0.5
+        games[(name, opponent)] += 1
+        opponents[name].append(opponent)
+    if not opponents:
+        return {}
+
+    ratings = dict.fromkeys(opponents, float(initial))
+    for _ in range(iterations):
+        updated = {}
+        for name, against in opponents.items():
+            score = expected = variance = 0.0
+            for opponent in against:
+                # get_winning_probability(r_b, r_a) is the expected score of a
+                p = elo.get_winning_probability(ratings[opponent], ratings[name])
+                score += scores[(name, opponent)]
+                expected += games[(name, opponent)] * p
+                variance += games[(name, opponent)] * p * (1 - p)
+            updated[name] = ratings[name] + 400 / log(10) * (score - expected) / variance
+        shift = initial - sum(updated.values()) / len(updated)     # only differences are fitted: average kept
+        updated = {name: rating + shift for name, rating in updated.items()}
+        converged = max(abs(updated[name] - ratings[name]) for name in ratings) < tolerance
+        ratings = updated
+        if converged:
+            break
+    return {name: round(rating) for name, rating in ratings.items()}
+
+
+def run(names: list[str], games: int, workers: int = None, seed: int = 0, batch_size: int = 50,
+        time_limit: float = 0.5) -> list[tuple[str, str, float]]:
+    tasks = []
+    for name_a, name_b in combinations(names, 2):
+        for start in range(0, games, batch_size):
+            tasks.append((name_a, name_b, min(batch_size, games - start), seed * 1000003 + len(tasks), time_limit))
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in executor.map(play_batch, *zip(*tasks)):
+            results.extend(batch)
+    return results
+
+
+def print_tables(names: list[str], results: list[tuple[str, str, float]], ratings: dict[str, int]):
+    table = defaultdict(lambda: [0, 0, 0])  # (player, opponent) -> wins, draws, losses
+    for name_a, name_b, score in results:
+        outcome = {1.0: 0, 0.5: 1, 0.0: 2}[score]
+        table[(name_a, name_b)][outcome] += 1
+        table[(name_b, name_a)][2 - outcome] += 1
+
+    width = max(len(name) for name in names) + 2
+    print("W/D/L".ljust(width) + "".join(name.ljust(16) for name in names))
+    for name in names:
+        row = name.ljust(width)
+        for opponent in names:
+            if opponent == name:
+                row += "-".ljust(16)
+            else:
+                wins, draws, losses = table[(name, opponent)]
+                row += f"{wins}/{draws}/{losses}".ljust(16)
+        print(row)
+
+    print("\nElo estimates")
+    for name in sorted(names, key=lambda n: ratings.get(n, 0), reverse=True):
+        wins = sum(table[(name, opponent)][0] for opponent in names if opponent != name)
+        draws = sum(table[(name, opponent)][1] for opponent in names if opponent != name)
+        losses = sum(table[(name, opponent)][2] for opponent in names if opponent != name)
+        print(f"{name.ljust(width)}{ratings.get(name, 0):>6}   ({wins}W {draws}D {losses}L)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pit Quarto strategies against each other.")
+    parser.add_argument("players", nargs="+", help="easy, medium, hard or module:Class")
+    parser.add_argument("--games", type=int, default=1000, help="games per pair of strategies")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--time-limit", type=float, default=0.5, help="seconds per move for 'hard'")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    results = run(args.players, args.games, args.workers, args.seed, args.batch_size, args.time_limit)
+    elapsed = perf_counter() - start
+    print(f"{len(results)} games in {elapsed:.1f}s ({len(results) / elapsed:.0f} games/s)\n")
+    print_tables(args.players, results, elo_ratings(results))
+
+
+if __name__ == "__main__":
+    main()
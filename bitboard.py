@@ -0,0 +1,149 @@
+from game import Piece, PieceVal, piece_codes, piece_indices
+from victory import cell_lines, line_masks, line_types, win_codes
+
+all_cells = 0xFFFF
+
+# the 4 attribute planes are packed in a single integer: plane b holds bit b of every piece, at bits 16*b..16*b+15
+plane_bits = [
+    [
+        sum(1 << (16 * b + cell) for b in range(4) if piece >> b & 1) for cell in range(16)
+    ] for piece in range(16)
+]
+plane_cell_masks = [sum(1 << (16 * b + cell) for b in range(4)) for cell in range(16)]
+
+
+def line_victory_code(planes: int, line_mask: int) -> int:
+    # the line must be full: collect the attribute bits shared by all of its pieces, then use the victory table
+    ones = zeros = 0
+    for bit in range(4):
+        plane = (planes >> (16 * bit)) & line_mask
+        if plane == line_mask:
+            ones |= 1 << bit
+        elif plane == 0:
+            zeros |= 1 << bit
+    return win_codes[ones << 4 | zeros]
+
+
+class BitBoard:
+    def __init__(self):
+        self.__board_dim = 4
+        self.__cells = 0        # 4 bits per cell, holding the piece index
+        self.__occupied = 0     # 1 bit per cell
+        self.__planes = 0       # 4 attribute planes of 16 bits each
+
+    @property
+    def board_dim(self):
+        return self.__board_dim
+
+    @property
+    def board(self):
+        return [
+            [
+                piece_codes[(self.__cells >> (4 * (4 * x + y))) & 0xF] if self.__occupied >> (4 * x + y) & 1 else 0
+                for y in range(self.__board_dim)
+            ] for x in range(self.__board_dim)
+        ]
+
+    @property
+    def cells(self):
+        return self.__cells
+
+    @property
+    def occupied(self):
+        return self.__occupied
+
+    @property
+    def planes(self):
+        return self.__planes
+
+    def set_board_dim(self, new_dim: int):
+        if new_dim != 4:
+            raise Exception("BitBoard only supports 4x4 boards")
+
+    def set_board(self, new_board: list[list[int]]):
+        self.__cells = 0
+        self.__occupied = 0
+        self.__planes = 0
+        for x, line in enumerate(new_board):
+            for y, code in enumerate(line):
+                if code != 0:
+                    self.place(4 * x + y, piece_indices[code])
+
+    @staticmethod
+    def from_cells(cells: list[int]):
+        new_board = BitBoard()
+        for cell, piece in enumerate(cells):
+            if piece >= 0:
+                new_board.place(cell, piece)
+        return new_board
+
+    def piece_at(self, cell: int) -> int:
+        if not self.__occupied >> cell & 1:
+            return -1
+        return (self.__cells >> (4 * cell)) & 0xF
+
+    def place(self, cell: int, piece: int):
+        self.__cells |= piece << (4 * cell)
+        self.__occupied |= 1 << cell
+        self.__planes |= plane_bits[piece][cell]
+
+    def place_piece(self, new_piece: Piece, pos_x: int, pos_y: int):
+        if not (0 <= pos_x < self.__board_dim and 0 <= pos_y < self.__board_dim):
+            raise Exception("Input arguments out of range")
+        cell = 4 * pos_x + pos_y
+        if self.__occupied >> cell & 1:    # overwrite the cell, like Board does
+            self.__cells &= ~(0xF << (4 * cell))
+            self.__occupied &= ~(1 << cell)
+            self.__planes &= ~plane_cell_masks[cell]
+        if new_piece.code != 0:
+            self.place(cell, piece_indices[new_piece.code])
+
+    def is_cell_free(self, pos_x: int, pos_y: int):
+        return not self.__occupied >> (4 * pos_x + pos_y) & 1
+
+    def is_board_full(self):
+        return self.__occupied == all_cells
+
+    def check_line(self, line_mask: int) -> int:
+        if self.__occupied & line_mask != line_mask:
+            return 0
+        return line_victory_code(self.__planes, line_mask)
+
+    def to_cells(self) -> list[int]:
+        return [self.piece_at(cell) for cell in range(16)]
+
+    def check_victory(self, pos_x: int, pos_y: int) -> (int, int):
+        if not (0 <= pos_x < self.__board_dim and 0 <= pos_y < self.__board_dim):
+            raise Exception("Input arguments out of range")
+        for i in cell_lines[4 * pos_x + pos_y]:     # row, col and (if any) diagonal through the cell
+            win_code = self.check_line(line_masks[i])
+            if win_code > 0:
+                return line_types[i], win_code
+        return 0, 0
+
+    def display(self):
+        message = "| ---- | ---- | ---- | ---- |\n"
+        for line_list in self.board:
+            parsed_list = [PieceVal(x).name for x in line_list]
+            message += "| " + " | ".join(parsed_list) + " |\n"
+        message += "| ---- | ---- | ---- | ---- |\n"
+        return message
+
+    def to_string(self):
+        matrix_string = ""
+        for line in self.board:
+            matrix_string += "_" + "_".join([str(x) for x in line])
+
+        output_string = f"BRD__{self.__board_dim}_{matrix_string}"
+        return output_string
+
+    @staticmethod
+    def from_string(board_string: str):
+        board_params = board_string.split("__")
+        board_dim = int(board_params[1])
+        board_list = [int(x) for x in board_params[2].split("_")]
+        board = [board_list[x*board_dim: x*board_dim + board_dim] for x in range(board_dim)]
+        new_board = BitBoard()
+        new_board.set_board_dim(board_dim)
+        new_board.set_board(board)
+        return new_board
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+
+from discord import ButtonStyle, PartialEmoji
+from discord.ui import View, Button
+
+from custom_ids import button_ids
+from game import Game, PieceEmoji, piece_labels
+
+# Board messages are 16 buttons, one per cell. What a cell looks like only depends on a few bits of the game, so:
+#   - the emoji of every piece (and of an empty cell) is parsed once, and every look a cell can have is a prebuilt
+#     template (style, disabled, emoji): a piece to pick, a piece already picked, a placed piece, an empty cell
+#   - the 16 templates of a board (its layout) are cached by a compact key of the state they depend on, so a board
+#     seen before is not computed again, and a new one is 16 table lookups
+# State keys (ints): bit 0 stage - 1, bit 1 game won, bits 2-17 cells of the winning line, then for the selection
+# stage the remaining pieces mask, for the placement stage the occupied cells mask and the 16 piece nibbles.
+
+piece_emojis = [PartialEmoji(name=label, id=PieceEmoji[label].value) for label in piece_labels]
+empty_emoji = PartialEmoji(name="NULL", id=PieceEmoji.NULL.value)
+
+# selection_cells[piece][available], the pieces being laid out like pieces_matrix
+selection_cells = [
+    ((ButtonStyle.red, True, emoji), (ButtonStyle.blurple, False, emoji)) for emoji in piece_emojis
+]
+# placement_cells[piece], [-1] for an empty cell (board.to_cells uses -1)
+placement_cells = [(ButtonStyle.gray, True, emoji) for emoji in piece_emojis] + [(ButtonStyle.gray, False, empty_emoji)]
+# played_cells[piece]: the cell that was just clicked, once the piece is picked or placed there
+played_cells = [(ButtonStyle.green, True, emoji) for emoji in piece_emojis]
+
+# cells of the line through (x, y) for each win condition (1 row, 2 col, 3 diag, 4 anti-diag)
+win_lines = {
+    1: lambda x, y: 0xF << 4 * x,
+    2: lambda x, y: 0x1111 << y,
+    3: lambda x, y: 0x8421,
+    4: lambda x, y: 0x1248,
+}
+
+
+def winning_cells(game: Game) -> int:
+    # mask of the cells to highlight, 0 if the game is not won (or won without a known line)
+    if game.state not in (1, 2) or game.win_cond not in win_lines:
+        return 0
+    return win_lines[game.win_cond](*game.last_xy)
+
+
+class BoardRenderer:
+    def __init__(self, max_layouts: int = 4096):
+        self.__layouts = OrderedDict()  # state key -> tuple of 16 cell templates, least recently used first
+        self.__max_layouts = max_layouts
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__layouts)
+
+    @staticmethod
+    def state_key(game: Game) -> (int, list[int]):
+        # (key, board cells or None), the cells being reused when the layout has to be built
+        won = game.state in (1, 2)
+        key = (game.stage - 1) | won << 1 | winning_cells(game) << 2
+        if game.stage == 1:
+            return key | game.remaining << 18, None
+        cells = game.board.to_cells()
+        occupied = 0
+        nibbles = 0
+        for cell, piece in enumerate(cells):
+            if piece >= 0:
+                occupied |= 1 << cell
+                nibbles |= piece << 4 * cell
+        return key | occupied << 18 | nibbles << 34, cells
+
+    def layout(self, game: Game) -> tuple:
+        # the 16 cell templates (style, disabled, emoji) of the game's board, row by row
+        key, cells = self.state_key(game)
+        layout = self.__layouts.get(key)
+        if layout is not None:
+            self.__layouts.move_to_end(key)
+            self.hits += 1
+            return layout
+        self.misses += 1
+
+        if game.stage == 1:
+            remaining = key >> 18
+            layout = [selection_cells[piece][remaining >> piece & 1] for piece in range(16)]
+        else:
+            layout = [placement_cells[piece] for piece in cells]
+        if key & 2:     # won: the winning line in green, everything else in gray
+            line = key >> 2 & 0xFFFF
+            layout = [
+                (ButtonStyle.green if line >> cell & 1 else ButtonStyle.gray, disabled, emoji)
+                for cell, (_, disabled, emoji) in enumerate(layout)
+            ]
+        layout = tuple(layout)
+
+        self.__layouts[key] = layout
+        if len(self.__layouts) > self.__max_layouts:
+            self.__layouts.popitem(last=False)
+        return layout
+
+    @staticmethod
+    def build_view(layout: tuple, game_id: str, stage: int, callback) -> View:
+        # the buttons of a layout, with the custom ids of the game's cells at that stage (see custom_ids)
+        view = View(timeout=None)
+        for cell, ((style, disabled, emoji), custom_id) in enumerate(zip(layout, button_ids(game_id, stage))):
+            button = Button(style=style, custom_id=custom_id, disabled=disabled, emoji=emoji, row=cell // 4)
+            button.callback = callback
+            view.add_item(button)
+        return view
+
+    def render_played(self, layout: tuple, game_id: str, stage: int, cell: int, piece: int, callback) -> View:
+        # a board already sent, with its clicked cell showing the piece picked or placed there: the message does not
+        # have to be fetched to update its buttons
+        return self.build_view(layout[:cell] + (played_cells[piece],) + layout[cell + 1:], game_id, stage, callback)
+
+    def render(self, game: Game, callback) -> View:
+        return self.build_view(self.layout(game), game.id, game.stage, callback)
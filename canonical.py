@@ -0,0 +1,121 @@
+from hashlib import blake2b
+from itertools import permutations
+
+from game import piece_indices
+from victory import lines
+
+# Quarto positions are equivalent under the 32 transforms of the board that map winning lines onto winning lines
+# (rotations, reflections, the inner/outer swap and the mid-flip), and under the 384 transforms of the pieces that
+# keep "sharing an attribute" unchanged (permutations of the 4 attributes combined with flips of any of them).
+# Positions are handled as 16-cell lists of piece indices (-1 for empty cells) plus the piece to be placed
+# (-1 in the selection stage).
+
+
+def _board_symmetries() -> list[tuple[int, ...]]:
+    # sources[i] is the cell whose piece ends up in cell i after the transform
+    line_set = {frozenset(line) for line in lines}
+    symmetries = []
+    for row_perm in permutations(range(4)):
+        for col_perm in permutations(range(4)):
+            for transpose in (False, True):
+                sources = [0] * 16
+                for x in range(4):
+                    for y in range(4):
+                        new_x, new_y = (col_perm[y], row_perm[x]) if transpose else (row_perm[x], col_perm[y])
+                        sources[4 * new_x + new_y] = 4 * x + y
+                mapped = {frozenset(sources.index(cell) for cell in line) for line in lines}
+                if mapped == line_set and tuple(sources) not in symmetries:
+                    symmetries.append(tuple(sources))
+    return symmetries
+
+
+board_symmetries = _board_symmetries()
+board_symmetries_inverse = [tuple(sources.index(cell) for cell in range(16)) for sources in board_symmetries]
+
+# attribute_permutations[k][p] is piece p with its 4 attribute bits reordered by the k-th permutation
+attribute_permutations = [
+    tuple(sum((p >> bit & 1) << order[bit] for bit in range(4)) for p in range(16))
+    for order in permutations(range(4))
+]
+
+
+class Transform:
+    def __init__(self, symmetry: int, permutation: int, flip: int):
+        self.__symmetry = symmetry
+        self.__permutation = permutation
+        self.__flip = flip
+
+    @property
+    def symmetry(self):
+        return self.__symmetry
+
+    @property
+    def permutation(self):
+        return self.__permutation
+
+    @property
+    def flip(self):
+        return self.__flip
+
+    def cell(self, cell: int) -> int:
+        # cell of the original position -> cell of the canonical position
+        return board_symmetries_inverse[self.__symmetry][cell]
+
+    def piece(self, piece: int) -> int:
+        return attribute_permutations[self.__permutation][piece] ^ self.__flip
+
+    def inverse_cell(self, cell: int) -> int:
+        return board_symmetries[self.__symmetry][cell]
+
+    def inverse_piece(self, piece: int) -> int:
+        return attribute_permutations[self.__permutation].index(piece ^ self.__flip)
+
+
+def canonical_form(cells: list[int], piece: int = -1) -> (int, Transform):
+    # smallest encoding among all equivalent positions: cells in order, then the piece to place, each as a
+    # base-17 digit (0 for empty). The flip is always chosen so that the first piece of the encoding becomes 0
+    best_key, best_transform = None, None
+    for symmetry, sources in enumerate(board_symmetries):
+        sequence = [cells[source] for source in sources]
+        first = next((p for p in sequence if p >= 0), piece)
+        if first < 0:   # empty board in the selection stage
+            return 0, Transform(0, 0, 0)
+        for permutation, table in enumerate(attribute_permutations):
+            flip = table[first]
+            key = 0
+            for p in sequence:
+                key = key * 17 + (table[p] ^ flip) + 1 if p >= 0 else key * 17
+            key = key * 17 + (table[piece] ^ flip) + 1 if piece >= 0 else key * 17
+            if best_key is None or key < best_key:
+                best_key, best_transform = key, (symmetry, permutation, flip)
+    return best_key, Transform(*best_transform)
+
+
+def canonical_key(cells: list[int], piece: int = -1) -> int:
+    return canonical_form(cells, piece)[0]
+
+
+def key_hash(key: int) -> int:
+    return int.from_bytes(blake2b(key.to_bytes(9, "little"), digest_size=8).digest(), "little")
+
+
+def key_digest(key: int) -> (int, int):
+    # 64-bit hash and 32-bit check of the canonical key, both halves of one digest: tables that only keep the hash
+    # compare the check too, so that two keys with the same hash are told apart
+    digest = blake2b(key.to_bytes(9, "little"), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:12], "little")
+
+
+def position_hash(cells: list[int], piece: int = -1) -> int:
+    # 64-bit hash of the canonical key, shared by all the equivalent positions
+    return key_hash(canonical_key(cells, piece))
+
+
+def board_hash(board) -> int:
+    # Board or BitBoard
+    return position_hash(board.to_cells())
+
+
+def game_hash(game) -> int:
+    piece = piece_indices.get(game.last_selected_piece.code, -1) if game.stage == 2 else -1
+    return position_hash(game.board.to_cells(), piece)
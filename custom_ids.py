@@ -0,0 +1,69 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import NamedTuple
+from uuid import UUID
+
+# custom_id of the board buttons. Current form, 26 characters:
+#   "q1:" version prefix, game UUID in unpadded url-safe base64 (22 characters), then one character for
+#   16 * (stage - 1) + cell (cell = 4 * x + y)
+# Messages sent by older versions carry "<game UUID>_<player 1>_<player 2>_<stage>_<x>_<y>", still accepted.
+# Decoding picks the decoder from the first 3 characters, so any other custom_id is rejected without parsing it.
+
+PREFIX = "q1:"
+cell_chars = "0123456789abcdefghijklmnopqrstuv"   # 16 * (stage - 1) + cell
+cell_values = {char: value for value, char in enumerate(cell_chars)}
+
+
+class ButtonTarget(NamedTuple):
+    game_id: str
+    stage: int
+    cell: int
+    player_1: int = None    # only in the old form
+    player_2: int = None
+
+
+def game_handle(game_id: str) -> str:
+    # the 22 characters standing for the game in its buttons
+    return urlsafe_b64encode(UUID(game_id).bytes).decode()[:22]
+
+
+def button_ids(game_id: str, stage: int) -> list[str]:
+    # custom_id of the 16 cells of a board, row by row
+    prefix = PREFIX + game_handle(game_id)
+    return [prefix + char for char in cell_chars[16 * (stage - 1):16 * stage]]
+
+
+def decode_current(custom_id: str) -> ButtonTarget:
+    if len(custom_id) != 26:
+        return None
+    value = cell_values.get(custom_id[25])
+    if value is None:
+        return None
+    try:
+        raw = urlsafe_b64decode(custom_id[3:25] + "==").hex()
+    except ValueError:
+        return None
+    game_id = f"{raw[:8]}-{raw[8:12]}-{raw[12:16]}-{raw[16:20]}-{raw[20:]}"     # str(UUID), without building one
+    return ButtonTarget(game_id, value // 16 + 1, value % 16)
+
+
+def decode_legacy(custom_id: str) -> ButtonTarget:
+    params = custom_id.split("_")
+    if len(params) != 6 or len(params[0]) != 36 or not all(param.isdigit() for param in params[1:]):
+        return None
+    stage, pos_x, pos_y = int(params[3]), int(params[4]), int(params[5])
+    if stage not in (1, 2) or pos_x > 3 or pos_y > 3:
+        return None
+    return ButtonTarget(params[0], stage, 4 * pos_x + pos_y, int(params[1]), int(params[2]))
+
+
+decoders = {PREFIX: decode_current}
+
+
+def decode_button(custom_id: str) -> ButtonTarget:
+    # the board button the custom_id stands for, or None if it is not one
+    decoder = decoders.get(custom_id[:3])
+    if decoder is not None:
+        return decoder(custom_id)
+    if len(custom_id) >= 36 and custom_id[8] == "-" and custom_id[36:37] == "_":    # "<uuid>_..."
+        return decode_legacy(custom_id)
+    return None
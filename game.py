@@ -1,32 +1,66 @@
+import struct
 from enum import Enum
-from math import prod
-from uuid import uuid4
+from time import time
+from types import MappingProxyType
+from uuid import UUID, uuid4
 from copy import deepcopy
+from victory import check_cells
 
-pieces_matrix = {
-            0: {
+# read-only, shared by all the games
+pieces_matrix = MappingProxyType({
+            0: MappingProxyType({
                 0: "LRTF", 1: "LRTH", 2: "LRSF", 3: "LRSH"
-            },
-            1: {
+            }),
+            1: MappingProxyType({
                 0: "LQTF", 1: "LQTH", 2: "LQSF", 3: "LQSH"
-            },
-            2: {
+            }),
+            2: MappingProxyType({
                 0: "DRTF", 1: "DRTH", 2: "DRSF", 3: "DRSH"
-            },
-            3: {
+            }),
+            3: MappingProxyType({
                 0: "DQTF", 1: "DQTH", 2: "DQSF", 3: "DQSH"
-            }
-        }
+            })
+        })
+
+
+# Binary form of a Game (to_bytes/from_bytes), 45 bytes instead of about 250 characters for to_string:
+#   version, cells (16 nibbles holding piece indices), occupied cells mask, remaining pieces mask,
+#   turn - 1 | (stage - 1) << 1 | state << 2 | win_cond << 4, last x << 4 | last y,
+#   last selected piece index (255 for none), last message id (0 for "default"), raw game UUID,
+#   start time in Unix seconds (since version 2), difficulty of the computer opponent (since version 3, index in
+#   difficulty_levels)
+GAME_FORMAT_VERSION = 3
+game_formats = {
+    1: struct.Struct("<B8sHHBBBQ16s"),
+    2: struct.Struct("<B8sHHBBBQ16sI"),
+    3: struct.Struct("<B8sHHBBBQ16sIB"),
+}
+NO_PIECE = 255
+difficulty_levels = (None, "easy", "medium", "hard")  # None for games between players
+GAME_ID_OFFSET = 24     # the UUID starts at the same offset in every version
 
 
 class Piece:
-    def __init__(self, piece_code: str = "LRTS"):
-        try:
-            self.__label = piece_code
-            self.__code: int = int(PieceVal[piece_code])
-        except KeyError:
-            self.__label = "NULL"
-            self.__code: int = 0
+    # immutable, and interned: Piece(label) always returns the same instance for a label, unknown labels the "NULL" one
+    __slots__ = ("__label", "__code")
+    __instances = {}
+
+    def __new__(cls, piece_code: str = "LRTS"):
+        piece = cls.__instances.get(piece_code)
+        if piece is None:
+            if piece_code not in PieceVal.__members__:
+                return cls("NULL")
+            piece = super().__new__(cls)
+            object.__setattr__(piece, "_Piece__label", piece_code)
+            object.__setattr__(piece, "_Piece__code", int(PieceVal[piece_code]))
+            cls.__instances[piece_code] = piece
+        return piece
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Piece objects are immutable")
+
+    def __reduce__(self):   # pickled by label, so that unpickling returns the shared instance
+        return Piece, (self.__label,)
 
     @property
     def code(self):
@@ -71,60 +105,23 @@ class Board:
     def is_board_full(self):
         return not any(0 in sublist for sublist in self.__board)
 
+    def to_cells(self) -> list[int]:
+        # flat list of piece indices (see piece_indices), -1 for empty cells
+        return [piece_indices.get(code, -1) for line in self.__board for code in line]
+
+    @staticmethod
+    def from_cells(cells: list[int]):
+        new_board = Board()
+        for cell, piece in enumerate(cells):
+            if piece >= 0:
+                new_board.board[cell // 4][cell % 4] = piece_codes[piece]
+        return new_board
+
     def check_victory(self, pos_x: int, pos_y: int) -> (int, int):
         if not (0 <= pos_x < self.__board_dim and 0 <= pos_y < self.__board_dim):
             raise Exception("Input arguments out of range")
-        # row check: multiply together all values in the row at x position
-        row_prod = prod(self.__board[pos_x])
-        row_win = self.is_winning_score(row_prod)
-        if row_win > 0:
-            return 1, row_win   # 1 means victory by row, row_win is the win code
-
-        # col check: multiply together all values in the col at y position
-        col_list = [x[pos_y] for x in self.__board]
-        col_prod = prod(col_list)
-        col_win = self.is_winning_score(col_prod)
-        if col_win > 0:
-            return 2, col_win   # 2 means victory by col, col_win is the win code
-
-        # diag check: if the position is on a main diagonal, multiply together all values in that diagonal
-        if pos_x == pos_y:  # diagonal from top left to bottom right
-            diag_list = [self.__board[i][i] for i in range(self.__board_dim)]
-            diag_prod = prod(diag_list)
-            diag_win = self.is_winning_score(diag_prod)
-            if diag_win > 0:
-                return 3, diag_win  # 3 means victory by first diag, diag_win is the win code
-
-        elif (pos_x + pos_y) == self.__board_dim - 1:   # diagonal from bottom left to top right
-            diag_list = [self.__board[i][self.__board_dim - 1 - i] for i in range(self.__board_dim)]
-            diag_prod = prod(diag_list)
-            diag_win = self.is_winning_score(diag_prod)
-            if diag_win > 0:
-                return 4, diag_win  # 4 means victory by second diag, diag_win is the winning code
-
-        return 0, 0
-
-    @staticmethod
-    def is_winning_score(score: int):
-        if score == 0:
-            return 0
-        if (score / float(PieceVal.L4)) % 1 == 0:   # victory with light pieces
-            return 1
-        if (score / float(PieceVal.D4)) % 1 == 0:   # victory with dark pieces
-            return 2
-        if (score / float(PieceVal.R4)) % 1 == 0:   # victory with round pieces
-            return 3
-        if (score / float(PieceVal.Q4)) % 1 == 0:   # victory with square pieces
-            return 4
-        if (score / float(PieceVal.T4)) % 1 == 0:   # victory with tall pieces
-            return 5
-        if (score / float(PieceVal.S4)) % 1 == 0:   # victory with short pieces
-            return 6
-        if (score / float(PieceVal.F4)) % 1 == 0:   # victory with full pieces
-            return 7
-        if (score / float(PieceVal.H4)) % 1 == 0:   # victory with hollow pieces
-            return 8
-        return 0
+        # rows, cols and diagonals through (pos_x, pos_y) are checked with the attribute masks of the pieces
+        return check_cells(self.to_cells(), pos_x * self.__board_dim + pos_y)
 
     def display(self):
         message = "| ---- | ---- | ---- | ---- |\n"
@@ -156,9 +153,13 @@ class Board:
 
 
 class Game:
-    def __init__(self, player_1, player_2, first_player: int = 1):
-        self.__board = Board()
-        self.__id = str(uuid4())
+    __slots__ = ("__board", "__id", "__started", "__p1", "__p2", "__turn", "__stage", "__state", "__win_cond",
+                 "__last_xy", "__last_selected_piece", "__last_message", "__remaining", "__difficulty", "__dirty")
+
+    def __init__(self, player_1, player_2, first_player: int = 1, board_type=Board, game_id: str = None):
+        self.__board = board_type()     # Board, or any engine with the same interface (e.g. bitboard.BitBoard)
+        self.__id = game_id if game_id is not None else str(uuid4())
+        self.__started = int(time())       # 0 when unknown (games saved before it was recorded)
         self.__p1 = player_1
         self.__p2 = player_2
         self.__turn: int = first_player     # 1 for player 1, 2 for player 2
@@ -168,25 +169,9 @@ class Game:
         self.__last_xy: tuple = (0, 0)
         self.__last_selected_piece: Piece = Piece("NULL")
         self.__last_message = "default"
-        self.__pieces = {
-            "LRTF": Piece("LRTF"),
-            "LRTH": Piece("LRTH"),
-            "LRSF": Piece("LRSF"),
-            "LRSH": Piece("LRSH"),
-            "LQTF": Piece("LQTF"),
-            "LQTH": Piece("LQTH"),
-            "LQSF": Piece("LQSF"),
-            "LQSH": Piece("LQSH"),
-            "DRTF": Piece("DRTF"),
-            "DRTH": Piece("DRTH"),
-            "DRSF": Piece("DRSF"),
-            "DRSH": Piece("DRSH"),
-            "DQTF": Piece("DQTF"),
-            "DQTH": Piece("DQTH"),
-            "DQSF": Piece("DQSF"),
-            "DQSH": Piece("DQSH")
-        }
-        self.__pieces_matrix = deepcopy(pieces_matrix)
+        self.__remaining: int = ALL_PIECES  # mask of the pieces not played yet, by index (see piece_labels)
+        self.__difficulty = None            # of the computer opponent, None between players
+        self.__dirty = True                 # changed since it was last saved
 
     @property
     def board(self):
@@ -196,6 +181,10 @@ class Game:
     def id(self):
         return self.__id
 
+    @property
+    def started(self):
+        return self.__started
+
     @property
     def turn(self):
         return self.__turn
@@ -205,12 +194,17 @@ class Game:
         return self.__stage
 
     @property
-    def pieces(self):
-        return self.__pieces
+    def pieces(self) -> dict[str, Piece]:
+        # the pieces not played yet, by label, in the order of piece_labels
+        return {piece.label: piece for index, piece in enumerate(all_pieces) if self.__remaining >> index & 1}
+
+    @property
+    def remaining(self) -> int:
+        return self.__remaining
 
     @property
     def pieces_matrix(self):
-        return self.__pieces_matrix
+        return pieces_matrix
 
     @property
     def state(self):
@@ -232,47 +226,87 @@ class Game:
     def last_selected_piece(self):
         return self.__last_selected_piece
 
+    @property
+    def difficulty(self):
+        return self.__difficulty
+
+    @property
+    def dirty(self):
+        return self.__dirty
+
+    def set_dirty(self, new_dirty: bool):
+        self.__dirty = new_dirty
+
     def get_players(self) -> tuple[int, int]:
         return int(self.__p1), int(self.__p2)
 
     def set_pieces(self, new_pieces: dict[str, Piece]):
-        self.__pieces = dict(new_pieces)
+        remaining = 0
+        for label in new_pieces:
+            remaining |= 1 << label_indices[label]
+        self.set_remaining(remaining)
+
+    def set_remaining(self, new_remaining: int):
+        self.__remaining = new_remaining
+        self.__dirty = True
 
     def set_last_xy(self, new_xy: tuple[int, int]):
         self.__last_xy = new_xy
+        self.__dirty = True
 
     def set_win_cond(self, new_win_cond: int):
         self.__win_cond = new_win_cond
+        self.__dirty = True
 
     def set_state(self, new_state: int):
         self.__state = new_state
+        self.__dirty = True
 
     def set_stage(self, new_stage: int):
         self.__stage = new_stage
+        self.__dirty = True
 
     def set_turn(self, new_turn: int):
         self.__turn = new_turn
+        self.__dirty = True
 
     def set_board(self, new_board: Board):
         self.__board = new_board
+        self.__dirty = True
 
     def set_id(self, new_id: str):
         self.__id = new_id
+        self.__dirty = True
+
+    def set_started(self, new_started: int):
+        self.__started = new_started
+        self.__dirty = True
 
     def set_selected_piece(self, new_label):
         self.__last_selected_piece = Piece(new_label)
+        self.__dirty = True
+
+    def set_difficulty(self, new_difficulty: str):
+        if new_difficulty not in difficulty_levels:
+            raise Exception(f"Unknown difficulty {new_difficulty}")
+        self.__difficulty = new_difficulty
+        self.__dirty = True
 
     def set_last_message(self, new_message):
         self.__last_message = str(new_message.id)
+        self.__dirty = True
 
     def set_last_message_id(self, new_message_id: str):
         self.__last_message = new_message_id
+        self.__dirty = True
 
     def next_turn(self):
         self.__turn = 3 - self.__turn
+        self.__dirty = True
 
     def change_stage(self):
         self.__stage = 3 - self.__stage
+        self.__dirty = True
 
     def is_board_full(self):
         return self.__board.is_board_full()
@@ -282,6 +316,7 @@ class Game:
             raise Exception("Input arguments out of range")
         if self.__board.is_cell_free(pos_x, pos_y):
             self.__board.place_piece(self.__last_selected_piece, pos_x, pos_y)
+            self.__dirty = True
             victory_by, victory_code = self.__board.check_victory(pos_x, pos_y)
             self.__last_xy = (pos_x, pos_y)
             if victory_by > 0:
@@ -292,13 +327,16 @@ class Game:
             return -1, -1
 
     def select_stage(self, piece_label: str = "NULL"):
-        if not self.__pieces:               # if there are no more pieces available to place
+        if not self.__remaining:            # if there are no more pieces available to place
             self.__state = 3                # the game results in a draw
+            self.__dirty = True
             return 2
 
-        if piece_label in self.__pieces:    # if the piece is still available
-            self.__last_selected_piece = self.__pieces[piece_label]
-            del self.__pieces[piece_label]
+        index = label_indices.get(piece_label)
+        if index is not None and self.__remaining >> index & 1:    # if the piece is still available
+            self.__last_selected_piece = all_pieces[index]
+            self.__remaining &= ~(1 << index)
+            self.__dirty = True
         else:
             return 0                        # if the piece was already placed, or does not exist
         return 1
@@ -309,15 +347,15 @@ class Game:
         output_string += f"_{self.__last_xy[0]}_{self.__last_xy[1]}"
         output_string += f"_{self.__last_selected_piece.label}_{self.__last_message}"
         output_string += f"_{self.__id}_"
-        output_string += "_".join(list(self.__pieces.keys()))
+        output_string += "_".join(self.pieces.keys())
         return output_string
 
     @staticmethod
-    def from_string(game_string: str, player_1: int, player_2: int):
+    def from_string(game_string: str, player_1: int, player_2: int, board_type=Board):
         board_sep = game_string.split("_ENDBRD_")     # separate board string from the rest
-        new_game = Game(player_1, player_2)
-        new_game.set_board(Board.from_string(board_sep[0]))
         game_params = board_sep[1].split("_")
+        new_game = Game(player_1, player_2, board_type=board_type, game_id=game_params[8])
+        new_game.set_board(board_type.from_string(board_sep[0]))
         new_game.set_turn(int(game_params[0]))
         new_game.set_stage(int(game_params[1]))
         new_game.set_state(int(game_params[2]))
@@ -325,15 +363,76 @@ class Game:
         new_game.set_last_xy((int(game_params[4]), int(game_params[5])))
         new_game.set_selected_piece(game_params[6])
         new_game.set_last_message_id(game_params[7])
-        new_game.set_id(game_params[8])
-        piece_labels = game_params[9:]
-        new_game_pieces = {
-            x: Piece(x) for x in piece_labels
-        }
-        new_game.set_pieces(new_game_pieces)
+        new_game.set_started(0)
+        remaining = 0
+        for label in game_params[9:]:   # no remaining pieces leaves an empty label
+            if label:
+                remaining |= 1 << label_indices[label]
+        new_game.set_remaining(remaining)
+        new_game.set_dirty(False)   # same as its stored form
 
         return new_game
 
+    def to_bytes(self) -> bytes:
+        if self.__board.board_dim != 4:
+            raise Exception("The binary form only supports 4x4 boards")
+        cells = bytearray(8)
+        occupied = 0
+        for cell, piece in enumerate(self.__board.to_cells()):
+            if piece >= 0:
+                cells[cell >> 1] |= piece << 4 * (cell & 1)
+                occupied |= 1 << cell
+        flags = (self.__turn - 1) | (self.__stage - 1) << 1 | self.__state << 2 | self.__win_cond << 4
+        return game_formats[GAME_FORMAT_VERSION].pack(
+            GAME_FORMAT_VERSION, bytes(cells), occupied, self.__remaining, flags,
+            self.__last_xy[0] << 4 | self.__last_xy[1],
+            piece_indices.get(self.__last_selected_piece.code, NO_PIECE),
+            0 if self.__last_message == "default" else int(self.__last_message),
+            UUID(self.__id).bytes, self.__started, difficulty_levels.index(self.__difficulty)
+        )
+
+    @staticmethod
+    def from_bytes(data, player_1: int, player_2: int, board_type=Board):
+        # data: bytes, bytearray or memoryview, read in place. Games still in the string form (a str, or bytes
+        # starting with "BRD") are read with from_string, so older snapshots keep loading
+        if isinstance(data, str):
+            return Game.from_string(data, player_1, player_2, board_type)
+        if data[:3] == b"BRD":
+            return Game.from_string(bytes(data).decode(), player_1, player_2, board_type)
+        if data[0] not in game_formats:
+            raise Exception(f"Unknown game format version {data[0]}")
+        _, cells, occupied, remaining, flags, xy, selected, message, game_id, *extra = \
+            game_formats[data[0]].unpack_from(data)
+
+        new_game = Game(player_1, player_2, board_type=board_type, game_id=str(UUID(bytes=game_id)))
+        new_game.set_board(board_type.from_cells([
+            cells[cell >> 1] >> 4 * (cell & 1) & 0xF if occupied >> cell & 1 else -1 for cell in range(16)
+        ]))
+        new_game.set_turn((flags & 1) + 1)
+        new_game.set_stage((flags >> 1 & 1) + 1)
+        new_game.set_state(flags >> 2 & 3)
+        new_game.set_win_cond(flags >> 4)
+        new_game.set_last_xy((xy >> 4, xy & 0xF))
+        new_game.set_selected_piece("NULL" if selected == NO_PIECE else piece_labels[selected])
+        new_game.set_last_message_id(str(message) if message else "default")
+        new_game.set_started(extra[0] if extra else 0)
+        new_game.set_difficulty(difficulty_levels[extra[1]] if len(extra) > 1 else None)
+        new_game.set_remaining(remaining)
+        new_game.set_dirty(False)   # same as its stored form
+
+        return new_game
+
+    @staticmethod
+    def id_from_bytes(data) -> str:
+        # the game id of a stored game (any form from_bytes reads), without decoding the rest
+        if isinstance(data, str) or data[:3] == b"BRD":
+            if not isinstance(data, str):
+                data = bytes(data).decode()
+            return data.split("_ENDBRD_")[1].split("_")[8]
+        if data[0] not in game_formats:
+            raise Exception(f"Unknown game format version {data[0]}")
+        return str(UUID(bytes=bytes(data[GAME_ID_OFFSET:GAME_ID_OFFSET + 16])))
+
     def __repr__(self):
         return f"Game object: {self.__p1} vs {self.__p2}"
 
@@ -428,3 +527,13 @@ class PieceEmoji(Enum):
     LRSH = 1085957028318552176
     LRTF = 1085957030566699131
     LRTH = 1085957154722287636
+
+
+# pieces indexed by their position in pieces_matrix (index = 4 * row + col): the 4 bits of the index are the
+# attributes of the piece, bit 3 light/dark, bit 2 round/square, bit 1 tall/short, bit 0 full/hollow
+piece_labels = [pieces_matrix[i // 4][i % 4] for i in range(16)]
+piece_codes = [PieceVal[label].value for label in piece_labels]
+piece_indices = {code: index for index, code in enumerate(piece_codes)}
+label_indices = {label: index for index, label in enumerate(piece_labels)}
+all_pieces = [Piece(label) for label in piece_labels]   # the shared Piece instances, by index
+ALL_PIECES = 0xFFFF
@@ -0,0 +1,150 @@
+from time import monotonic
+
+from game import Game
+
+# Active games, found in O(1) by (player_1, player_2), by either order of the players, by game id (the one in the
+# buttons' custom ids) and by player. Games are kept in their stored form (whatever the storage backend loaded, e.g.
+# base64 or bytes) and only turned into Game objects the first time they are used, so startup time and memory follow
+# the players who are actually playing. Games left idle are turned back into their stored form by evict_idle.
+# The pair and player indexes hold every game of a pair or player, so several games between the same players would
+# not need any change here; the (player_1, player_2) lookups return the one game the bot currently allows.
+
+
+class GameEntry:
+    __slots__ = ("player_1", "player_2", "game_id", "stored", "game", "last_used")
+
+    def __init__(self, player_1: int, player_2: int, game_id: str, stored=None, game: Game = None):
+        self.player_1 = player_1
+        self.player_2 = player_2
+        self.game_id = game_id
+        self.stored = stored        # up to date unless the game is dirty, None until a new game is first encoded
+        self.game = game            # None while the game is not in use
+        self.last_used = 0.0        # monotonic time of the last get
+
+
+def pair_key(player_a: int, player_b: int) -> (int, int):
+    return (player_a, player_b) if player_a <= player_b else (player_b, player_a)
+
+
+class GameIndex:
+    def __init__(self, decode=Game.from_bytes, encode=Game.to_bytes, identify=Game.id_from_bytes):
+        self.__decode = decode          # (stored, player_1, player_2) -> Game
+        self.__encode = encode          # Game -> stored
+        self.__identify = identify      # stored -> game id
+        self.__entries = {}             # (player_1, player_2) -> GameEntry
+        self.__by_id = {}               # game id -> GameEntry
+        self.__by_pair = {}             # pair_key -> {game id: GameEntry}
+        self.__by_player = {}           # user id -> {game id: GameEntry}, as either player
+        self.__loaded = {}              # game id -> GameEntry, for the games in use
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def loaded(self):
+        return len(self.__loaded)
+
+    def has(self, player_1: int, player_2: int) -> bool:
+        return (player_1, player_2) in self.__entries
+
+    def has_pair(self, player_a: int, player_b: int) -> bool:
+        # whether the two players have a game, whoever is player 1
+        return pair_key(player_a, player_b) in self.__by_pair
+
+    def has_player(self, player: int) -> bool:
+        # whether the player is in any game
+        return player in self.__by_player
+
+    def pairs(self):
+        return self.__entries.keys()
+
+    def player_pairs(self, player: int) -> list[tuple[int, int]]:
+        # (player_1, player_2) of every game of the player
+        return [(entry.player_1, entry.player_2) for entry in self.__by_player.get(player, {}).values()]
+
+    def __index(self, entry: GameEntry):
+        self.__entries[(entry.player_1, entry.player_2)] = entry
+        self.__by_id[entry.game_id] = entry
+        self.__by_pair.setdefault(pair_key(entry.player_1, entry.player_2), {})[entry.game_id] = entry
+        for player in (entry.player_1, entry.player_2):
+            self.__by_player.setdefault(player, {})[entry.game_id] = entry
+
+    def __unindex(self, entry: GameEntry):
+        del self.__entries[(entry.player_1, entry.player_2)]
+        del self.__by_id[entry.game_id]
+        self.__loaded.pop(entry.game_id, None)
+        for index, key in ((self.__by_pair, pair_key(entry.player_1, entry.player_2)),
+                           (self.__by_player, entry.player_1), (self.__by_player, entry.player_2)):
+            games = index.get(key)
+            if games is not None:
+                games.pop(entry.game_id, None)
+                if not games:
+                    del index[key]
+
+    def __use(self, entry: GameEntry) -> Game:
+        if entry.game is None:
+            entry.game = self.__decode(entry.stored, entry.player_1, entry.player_2)
+            self.__loaded[entry.game_id] = entry
+        entry.last_used = monotonic()
+        return entry.game
+
+    def load_stored(self, player_1: int, player_2: int, stored):
+        # adds a game in its stored form, without decoding it (replacing any game of the same players)
+        if (player_1, player_2) in self.__entries:
+            self.__unindex(self.__entries[(player_1, player_2)])
+        self.__index(GameEntry(player_1, player_2, self.__identify(stored), stored))
+
+    def get(self, player_1: int, player_2: int) -> Game:
+        # the game between the two players, or None
+        entry = self.__entries.get((player_1, player_2))
+        return self.__use(entry) if entry is not None else None
+
+    def find(self, player_a: int, player_b: int) -> Game:
+        # the game between the two players whoever is player 1, or None
+        games = self.__by_pair.get(pair_key(player_a, player_b))
+        return self.__use(next(iter(games.values()))) if games else None
+
+    def by_id(self, game_id: str) -> Game:
+        entry = self.__by_id.get(game_id)
+        return self.__use(entry) if entry is not None else None
+
+    def add(self, game: Game):
+        player_1, player_2 = game.get_players()
+        if (player_1, player_2) in self.__entries:
+            self.__unindex(self.__entries[(player_1, player_2)])
+        entry = GameEntry(player_1, player_2, game.id, game=game)  # encoded when it is first flushed or evicted
+        entry.last_used = monotonic()
+        self.__index(entry)
+        self.__loaded[entry.game_id] = entry
+
+    def remove(self, player_1: int, player_2: int):
+        self.__unindex(self.__entries[(player_1, player_2)])
+
+    def pop_dirty(self) -> list[tuple[int, int, object]]:
+        # (player_1, player_2, stored form) of every game changed since the last call, which are encoded again
+        changed = []
+        for entry in self.__loaded.values():
+            if entry.game.dirty:
+                entry.stored = self.__encode(entry.game)
+                entry.game.set_dirty(False)
+                changed.append((entry.player_1, entry.player_2, entry.stored))
+        return changed
+
+    def stored_games(self) -> dict[int, dict[int, object]]:
+        # {player_1: {player_2: stored form}}, as of the last pop_dirty
+        games = {}
+        for (p1, p2), entry in self.__entries.items():
+            games.setdefault(p1, {})[p2] = entry.stored
+        return games
+
+    def evict_idle(self, max_idle: float) -> int:
+        # drops the Game objects unused for max_idle seconds; dirty ones wait until they are flushed
+        now = monotonic()
+        idle = [
+            entry for entry in self.__loaded.values()
+            if not entry.game.dirty and entry.stored is not None and now - entry.last_used >= max_idle
+        ]
+        for entry in idle:
+            entry.game = None
+            del self.__loaded[entry.game_id]
+        return len(idle)
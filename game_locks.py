@@ -0,0 +1,40 @@
+import asyncio
+from collections import OrderedDict
+from weakref import WeakValueDictionary
+
+# A move reads a game, awaits Discord a few times and then records the message it sent, so two clicks on the same
+# game (or a click and the bot's reply) must not interleave. Each game has its own lock, so different games never wait
+# for each other; the locks are only weakly referenced, and disappear once no move holds or waits for them.
+# Interactions Discord delivers twice are recognised by their id and dropped.
+
+
+class GameLocks:
+    def __init__(self):
+        self.__locks = WeakValueDictionary()   # game id -> asyncio.Lock
+
+    def __len__(self):
+        return len(self.__locks)
+
+    def lock(self, game_id: str) -> asyncio.Lock:
+        # use as "async with game_locks.lock(game_id):", which keeps the lock alive while it is needed
+        lock = self.__locks.get(game_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.__locks[game_id] = lock
+        return lock
+
+
+class SeenInteractions:
+    # ids of the last max_size interactions, oldest first
+    def __init__(self, max_size: int = 4096):
+        self.__ids = OrderedDict()
+        self.__max_size = max_size
+
+    def seen(self, interaction_id: int) -> bool:
+        # whether the interaction was already handled; records it otherwise
+        if interaction_id in self.__ids:
+            return True
+        self.__ids[interaction_id] = None
+        if len(self.__ids) > self.__max_size:
+            self.__ids.popitem(last=False)
+        return False
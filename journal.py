@@ -0,0 +1,166 @@
+import json
+import os
+from base64 import b64decode, b64encode
+
+from game import Game
+from game_index import GameIndex
+
+# Active games are persisted as a snapshot (games.json) plus an append-only journal with one compact JSON record per
+# change. Every record carries a sequence number, and the snapshot stores the last one it includes, so a crash in the
+# middle of a compaction never replays a record twice.
+# Records: "new" (encoded game), "sel" (piece selected), "pl" (piece placed), "msg" (board message), "end".
+# Compaction first rotates the journal to "<journal>.old" (on the event loop, so no record can be lost), then writes
+# the snapshot and removes the old journal, which can happen in another thread.
+
+
+def encode_game(game: Game) -> str:
+    # binary form in base64, about 5 times shorter than the string form
+    return b64encode(game.to_bytes()).decode()
+
+
+def decode_game(stored: str, player_1: int, player_2: int) -> Game:
+    if stored.startswith("BRD"):    # string form, written by older versions
+        return Game.from_string(stored, player_1, player_2)
+    return Game.from_bytes(b64decode(stored), player_1, player_2)
+
+
+def game_id_of(stored: str) -> str:
+    if stored.startswith("BRD"):
+        return Game.id_from_bytes(stored)
+    return Game.id_from_bytes(b64decode(stored))
+
+
+def atomic_write(path: str, data: bytes):
+    # readers see either the old file or the new one, never a truncated one
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+
+class GameJournal:
+    def __init__(self, snapshot_path: str = "games.json", journal_path: str = "games.journal"):
+        self.__snapshot_path = snapshot_path
+        self.__journal_path = journal_path
+        self.__seq = 0
+        self.__records = 0      # records written since the last snapshot
+        self.__file = None
+
+    @property
+    def records(self):
+        return self.__records
+
+    def load(self) -> GameIndex:
+        # the snapshot games stay encoded until they are used, only those in the journal are decoded to replay it
+        active_games = GameIndex(decode_game, encode_game, game_id_of)
+        snapshot_seq = 0
+        try:
+            with open(self.__snapshot_path, "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if "games" in snapshot:
+                snapshot_seq = snapshot["seq"]
+                snapshot = snapshot["games"]
+            for p1 in snapshot.keys():
+                for p2, stored in snapshot[p1].items():
+                    active_games.load_stored(int(p1), int(p2), stored)
+        except FileNotFoundError:
+            pass
+        self.__seq = snapshot_seq
+
+        for path in (self.__journal_path + ".old", self.__journal_path):  # an interrupted compaction leaves .old
+            try:
+                with open(path, "r") as journal_file:
+                    for line in journal_file:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:    # last record cut short by a crash
+                            break
+                        if record["s"] <= self.__seq:
+                            continue
+                        self.__apply(active_games, record)
+                        self.__seq = record["s"]
+                        self.__records += 1
+            except FileNotFoundError:
+                pass
+
+        old_path = self.__journal_path + ".old"
+        if os.path.exists(old_path):     # fold it back in, so the next compaction can rotate again
+            with open(old_path, "rb") as old_file:
+                data = old_file.read()
+            data = data[:data.rfind(b"\n") + 1]
+            try:
+                with open(self.__journal_path, "rb") as journal_file:
+                    data += journal_file.read()
+            except FileNotFoundError:
+                pass
+            atomic_write(self.__journal_path, data)
+            os.remove(old_path)
+
+        self.__file = open(self.__journal_path, "a")
+        return active_games
+
+    @staticmethod
+    def __apply(active_games: GameIndex, record: dict):
+        p1, p2 = record["p1"], record["p2"]
+        if record["op"] == "new":
+            active_games.load_stored(p1, p2, record["g"])
+            return
+        game = active_games.get(p1, p2)
+        if game is None:
+            return
+        if record["op"] == "sel":       # same transitions as on_interaction
+            if game.select_stage(record["piece"]) == 1:
+                game.change_stage()
+                game.next_turn()
+        elif record["op"] == "pl":
+            victory_by, _ = game.place_stage(record["x"], record["y"])
+            if victory_by == 0:
+                game.change_stage()
+        elif record["op"] == "msg":
+            game.set_last_message_id(record["m"])
+        elif record["op"] == "end":
+            active_games.remove(p1, p2)
+
+    def append(self, op: str, game: Game, **fields):
+        p1, p2 = game.get_players()
+        self.__seq += 1
+        self.__records += 1
+        record = {"s": self.__seq, "op": op, "p1": p1, "p2": p2, **fields}
+        self.__file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.__file.flush()
+
+    def log_new(self, game: Game):
+        self.append("new", game, g=encode_game(game))
+
+    def log_select(self, game: Game, piece_label: str):
+        self.append("sel", game, piece=piece_label)
+
+    def log_place(self, game: Game, pos_x: int, pos_y: int):
+        self.append("pl", game, x=pos_x, y=pos_y)
+
+    def log_message(self, game: Game):
+        self.append("msg", game, m=game.last_message)
+
+    def log_end(self, game: Game):
+        self.append("end", game)
+
+    def rotate(self) -> int:
+        # starts a new journal, and returns the sequence number the next snapshot must include (None while the last
+        # snapshot is still being written)
+        old_path = self.__journal_path + ".old"
+        if os.path.exists(old_path):
+            return None
+        self.__file.close()
+        os.replace(self.__journal_path, old_path)
+        self.__file = open(self.__journal_path, "a")
+        self.__records = 0
+        return self.__seq
+
+    def write_snapshot(self, seq: int, games: dict[int, dict[int, str]]) -> int:
+        # games are already encoded; returns the number of bytes written
+        data = json.dumps({"seq": seq, "games": games}, separators=(",", ":")).encode()
+        atomic_write(self.__snapshot_path, data)
+        os.remove(self.__journal_path + ".old")
+        return len(data)
@@ -0,0 +1,124 @@
+from bisect import bisect_left, insort
+
+# Players sorted by Elo (highest first, ties by user id), updated one player at a time.
+# The order is kept as a list of sorted chunks of at most 2 * CHUNK_SIZE keys, and a Fenwick tree over the chunk
+# lengths gives the number of players before any chunk, so rank and position queries take O(log n) plus the size
+# of one chunk, instead of sorting all the ratings again.
+
+CHUNK_SIZE = 512
+
+
+class Leaderboard:
+    def __init__(self, ratings: dict[int, dict] = None):
+        self.__keys = {}        # user_id -> (-elo, user_id), the sort key
+        self.__chunks = []      # sorted lists of keys
+        self.__maxes = []       # last key of each chunk
+        self.__tree = []        # Fenwick tree over the chunk lengths
+        if ratings:
+            self.__keys = {user_id: (-rating["elo"], user_id) for user_id, rating in ratings.items()}
+            ordered = sorted(self.__keys.values())
+            self.__chunks = [ordered[i:i + CHUNK_SIZE] for i in range(0, len(ordered), CHUNK_SIZE)]
+            self.__rebuild()
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __contains__(self, user_id: int):
+        return user_id in self.__keys
+
+    def __rebuild(self):
+        # after chunks are added or removed
+        self.__maxes = [chunk[-1] for chunk in self.__chunks]
+        self.__tree = [0] * (len(self.__chunks) + 1)
+        for i, chunk in enumerate(self.__chunks):
+            self.__add_length(i, len(chunk))
+
+    def __add_length(self, chunk_index: int, delta: int):
+        i = chunk_index + 1
+        while i < len(self.__tree):
+            self.__tree[i] += delta
+            i += i & -i
+
+    def __before(self, chunk_index: int) -> int:
+        # number of players in the chunks before chunk_index
+        total = 0
+        i = chunk_index
+        while i > 0:
+            total += self.__tree[i]
+            i -= i & -i
+        return total
+
+    def __locate(self, position: int) -> (int, int):
+        # (chunk, offset in the chunk) of the 0-based position, by descending the Fenwick tree
+        chunk_index = 0
+        step = 1 << (len(self.__tree).bit_length() - 1)
+        while step:
+            if chunk_index + step < len(self.__tree) and self.__tree[chunk_index + step] <= position:
+                chunk_index += step
+                position -= self.__tree[chunk_index]
+            step >>= 1
+        return chunk_index, position
+
+    def __insert(self, key: tuple):
+        if not self.__chunks:
+            self.__chunks.append([key])
+            self.__rebuild()
+            return
+        chunk_index = min(bisect_left(self.__maxes, key), len(self.__chunks) - 1)
+        chunk = self.__chunks[chunk_index]
+        insort(chunk, key)
+        self.__maxes[chunk_index] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self.__chunks[chunk_index:chunk_index + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self.__rebuild()
+        else:
+            self.__add_length(chunk_index, 1)
+
+    def __remove(self, key: tuple):
+        chunk_index = bisect_left(self.__maxes, key)
+        chunk = self.__chunks[chunk_index]
+        del chunk[bisect_left(chunk, key)]
+        if not chunk:
+            del self.__chunks[chunk_index]
+            self.__rebuild()
+        else:
+            self.__maxes[chunk_index] = chunk[-1]
+            self.__add_length(chunk_index, -1)
+
+    def update(self, user_id: int, elo: int):
+        # adds the player, or moves them to their new rating
+        key = (-elo, user_id)
+        old_key = self.__keys.get(user_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self.__remove(old_key)
+        self.__keys[user_id] = key
+        self.__insert(key)
+
+    def remove(self, user_id: int):
+        self.__remove(self.__keys.pop(user_id))
+
+    def elo(self, user_id: int) -> int:
+        return -self.__keys[user_id][0]
+
+    def rank(self, user_id: int) -> int:
+        # 1 for the best player; KeyError for players without a rating
+        key = self.__keys[user_id]
+        chunk_index = bisect_left(self.__maxes, key)
+        return self.__before(chunk_index) + bisect_left(self.__chunks[chunk_index], key) + 1
+
+    def players(self, start: int, end: int) -> list[int]:
+        # user ids ranked start to end, both included (1-based, like the ranks shown to the players)
+        start = max(1, start)
+        end = min(end, len(self))
+        result = []
+        if start > end:
+            return result
+        chunk_index, offset = self.__locate(start - 1)
+        while len(result) < end - start + 1:
+            chunk = self.__chunks[chunk_index]
+            result.extend(user_id for _, user_id in chunk[offset:offset + end - start + 1 - len(result)])
+            chunk_index += 1
+            offset = 0
+        return result
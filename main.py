@@ -1,17 +1,23 @@
+import asyncio
 import os
 import sys
 
-import discord
 from discord.ext import commands as dc, tasks
 from discord import Intents, User, Embed
-from discord.ui import View, Button
-from game import Game, VictoryPieceType, PieceVal, PieceEmoji
-from re import compile, match
+from game import Game, VictoryPieceType, piece_indices
 from discord_classes import BoardView
-import json
-import elo
+from board_render import BoardRenderer
+from custom_ids import ButtonTarget, decode_button
+from game_locks import GameLocks, SeenInteractions
+from outbound import OutboundScheduler
+from storage import history_entry, open_storage
+from leaderboard import Leaderboard
+import rating_models
+import ai
+import ai_worker
 from textwrap import dedent
 from random import choice
+from time import time
 
 assert sys.version_info >= (3, 10)
 
@@ -23,28 +29,26 @@ this_dir = os.path.dirname(__file__)
 relative_token = "../../Desktop/quarto_token.txt"
 absolute_token = os.path.join(this_dir, relative_token)
 
-with open(absolute_token, "r") as f:
-    TOKEN = f.readline()
+# the saved state is loaded by load_state when the bot starts, not on import: the worker processes of ai_executor
+# import this module too
+storage = None
+active_games = None     # games are decoded when first used, see GameIndex
+GAME_IDLE_SECONDS = float(os.environ.get("QUARTO_GAME_IDLE", 1800))    # then they go back to their stored form
+ratings = None
+guild_ratings = None    # ratings of the games played in each server
 
-try:
-    with open("games.json", "r") as games_json:
-        active_games = json.load(games_json)
-        active_games = {
-            int(p1): {
-                int(p2): Game.from_string(g_str, p1, p2) for p2, g_str in active_games[p1].items()
-            } for p1 in active_games.keys()
-        }
-except FileNotFoundError:
-    active_games = {}
+leaderboard = None      # kept up to date by update_leaderboard
+guild_leaderboards = {}     # guild_id -> Leaderboard, built when the server's leaderboard is first shown
 
-try:
-    with open("ratings.json", "r") as ratings_json:
-        ratings = json.load(ratings_json)
-        ratings = {int(key): val for key, val in ratings.items()}
-except FileNotFoundError:
-    ratings = {}
+# "elo" rates every game when it ends, "glicko2" rates the games of each rating period together (see rating_period).
+# Results still pending at a restart are only kept in the match history
+rating_model = rating_models.models[os.environ.get("QUARTO_RATING_MODEL", "elo")]()
+RATING_PERIOD_MINUTES = float(os.environ.get("QUARTO_RATING_PERIOD", 60))
+pending_results = []    # (winner, loser, guild_id, rated globally) of the games ended in the current rating period
 
-leaderboard = []
+board_renderer = BoardRenderer()    # board layouts by game state, see board_render
+bot_thinking = set()    # ids of the games whose bot move is being computed, one at a time
+ai_executor = None      # worker processes of the computer opponent, started with the bot
 
 
 class PersistentBot(dc.Bot):
@@ -55,15 +59,30 @@ class PersistentBot(dc.Bot):
         super().__init__(command_prefix=dc.when_mentioned_or("q!"), intents=intents, help_command=None)
 
     async def setup_hook(self) -> None:
+        global ai_executor
+        load_state()
+        ai_executor = ai_worker.start_pool()
         self.add_view(BoardView())
 
 
+def load_state():
+    global storage, active_games, ratings, guild_ratings, leaderboard
+    # "json" (games.json + journal, ratings.json) or "sqlite" (quarto.db)
+    storage = open_storage(os.environ.get("QUARTO_STORAGE", "json"), os.environ.get("QUARTO_DB"))
+    active_games = storage.load_games()
+    ratings = storage.load_ratings()
+    guild_ratings = storage.load_guild_ratings()
+    leaderboard = Leaderboard(ratings)
+
+
 bot = PersistentBot()
 
 pending_challenges = {}
-button_id_pattern = compile(
-    "^[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}_[0-9]{18}_[0-9]{18}_[0-9]_[0-9]_[0-9]$"
-)
+game_locks = GameLocks()    # game id -> lock held while a move is played
+seen_interactions = SeenInteractions()
+outbound = OutboundScheduler()   # board messages and edits of the game flow, queued per channel
+# live boards: every game keeps one board message, edited after each move instead of posting a new one
+LIVE_BOARD = os.environ.get("QUARTO_LIVE_BOARD", "0") == "1"
 
 
 @bot.event
@@ -71,24 +90,19 @@ async def on_ready():
     print(f"Ready and running as {bot.user}")
     if not save.is_running():
         save.start()
+    if rating_model.batched and not rating_period.is_running():
+        rating_period.start()
 
 
 @tasks.loop(minutes=1.0)
 async def save():
     print("'save' task started.")
-    updated_games_json = {
-        p1: {
-            p2: g.to_string() for p2, g in active_games[p1].items()
-        } for p1 in active_games.keys()
-    }
-    with open("games.json", "w") as new_games_json:
-        json.dump(updated_games_json, new_games_json, indent=4)
-    print("'games.json' saved.")
-
-    with open("ratings.json", "w") as new_ratings_json:
-        json.dump(ratings, new_ratings_json, indent=4)
-    print("'ratings.json' saved.")
-    update_leaderboard()
+    batch = storage.prepare_flush(active_games, ratings, guild_ratings)   # only what changed, serialized on the loop
+    await asyncio.get_running_loop().run_in_executor(None, storage.write_flush, batch)
+    print(f"games and ratings saved: {storage.metrics}")
+    evicted = active_games.evict_idle(GAME_IDLE_SECONDS)
+    print(f"{evicted} idle games evicted, {active_games.loaded} of {len(active_games)} games loaded.")
+    print(f"outbound queues: {outbound.metrics}, {outbound.channels()} channels busy.")
 
 
 @save.before_loop
@@ -96,6 +110,46 @@ async def before():
     await bot.wait_until_ready()
 
 
+@tasks.loop(minutes=RATING_PERIOD_MINUTES)
+async def rating_period():
+    # rates the games ended since the last period, globally and in each server
+    if not pending_results:
+        return
+    results = pending_results.copy()
+    pending_results.clear()
+    period = current_period()
+    changed = rate_results([(winner, loser) for winner, loser, _, rated in results if rated], period)
+    by_guild = {}
+    for winner, loser, guild_id, _ in results:
+        if guild_id is not None:
+            by_guild.setdefault(guild_id, []).append((winner, loser))
+    for guild_id, guild_results in by_guild.items():
+        rate_results(guild_results, period, guild_id)
+    print(f"rating period {period}: {len(results)} games, {len(changed)} players rated globally, "
+          f"{len(by_guild)} servers.")
+
+
+@rating_period.before_loop
+async def before_rating_period():
+    await bot.wait_until_ready()
+
+
+def current_period() -> int:
+    return int(time() // (RATING_PERIOD_MINUTES * 60))
+
+
+def rate_results(results: list[tuple[int, int]], period: int, guild_id: int = None) -> set[int]:
+    # rates (winner, loser) results globally or in a server, then moves the players in the leaderboard and records
+    # their new rating in the history
+    scope_ratings = ratings if guild_id is None else guild_ratings.scope(guild_id)
+    changed = rating_model.rate(scope_ratings, results, period)
+    update_leaderboard(*changed, guild_id=guild_id)
+    storage.record_ratings([
+        history_entry(user_id, scope_ratings[user_id], rating_model.name, guild_id, period) for user_id in changed
+    ])
+    return changed
+
+
 @bot.event
 async def on_command_error(context, error):
     if isinstance(error, dc.CommandNotFound):
@@ -111,83 +165,78 @@ async def on_interaction(interaction):
     if interaction.data["component_type"] != 2:     # the interactive element is not a button
         return
 
-    if not match(button_id_pattern, interaction.data["custom_id"]):  # the button is not that of a game
+    target = decode_button(interaction.data["custom_id"])
+    if target is None:  # the button is not that of a game
         return
 
-    custom_id_params = interaction.data["custom_id"].split("_")
-    game_id = custom_id_params[0]
-    p1 = int(custom_id_params[1])
-    p2 = int(custom_id_params[2])
-    stage = int(custom_id_params[3])
-    pos_x = int(custom_id_params[4])
-    pos_y = int(custom_id_params[5])
-
-    if p1 not in active_games:  # the first player has no active games
-        await interaction.response.send_message(
-            f"Hey <@{interaction.user.id}>, it looks like you have no active games anymore!"
-        )
+    if seen_interactions.seen(interaction.id):  # delivered twice
         return
 
-    if p2 not in active_games[p1]:  # if there is not a game between them
-        await interaction.response.send_message(
-            f"Hey <@{interaction.user.id}>, there is no active game between you and your opponent!"
-        )
+    async with game_locks.lock(target.game_id):    # play_move checks and plays on the game as the last move left it
+        await play_move(interaction, target)
+    selected_game = active_games.by_id(target.game_id)
+    if selected_game is not None:
+        await play_bot_turn(interaction.channel, *selected_game.get_players())
+
+
+async def play_move(interaction, target: ButtonTarget):
+    selected_game = active_games.by_id(target.game_id)
+    if selected_game is None:
+        # buttons of the old form also name the players, the others are checked against the one who clicked
+        p1 = interaction.user.id if target.player_1 is None else target.player_1
+        if not active_games.has_player(p1):  # the first player has no active games
+            await interaction.response.send_message(
+                f"Hey <@{interaction.user.id}>, it looks like you have no active games anymore!"
+            )
+        elif target.player_2 is not None and not active_games.has(p1, target.player_2):  # no game between them
+            await interaction.response.send_message(
+                f"Hey <@{interaction.user.id}>, there is no active game between you and your opponent!"
+            )
+        else:   # the button is that of an older game between them
+            await interaction.response.send_message(
+                f"Hey <@{interaction.user.id}>, that game is no longer valid!"
+            )
         return
-
-    selected_game = active_games[p1][p2]
+    p1, p2 = selected_game.get_players()
+    stage = target.stage
+    pos_x, pos_y = divmod(target.cell, 4)
 
     if interaction.user.id != p1 and interaction.user.id != p2:     # the caller is not a player
         await interaction.response.send_message("Let the players play their game, please.")
         return
 
-    if str(interaction.message.id) != selected_game.last_message:   # not the last message sent by bot
+    if str(interaction.message.id) != selected_game.last_message:   # not the game's board
         await interaction.response.send_message("This message has expired.")
         return
 
-    if str(selected_game.id) != game_id:  # if the id is not the same as that recovered from the button
-        await interaction.response.send_message(
-            f"Hey <@{interaction.user.id}>, that game is no longer valid!"
-        )
-        return
-
     if selected_game.stage != stage:  # if the stage from the button is different from that of the active game
         await interaction.response.send_message(
             f"Hey <@{interaction.user.id}>, that is not the current stage of the game!"
         )
         return
 
-    if str(interaction.user.id) != custom_id_params[selected_game.turn]:  # if it's not your turn
+    if interaction.user.id != (p1, p2)[selected_game.turn - 1]:  # if it's not your turn
         await interaction.response.send_message(
             f"Hey <@{interaction.user.id}>, it's not your turn! Wait for your opponent."
         )
         return
 
-    previous_message = await interaction.channel.fetch_message(
-        int(selected_game.last_message)
-    )
-    new_view = View.from_message(previous_message)
-    button_row = [
-        new_view.children[pos_x * 4],
-        new_view.children[pos_x * 4 + 1],
-        new_view.children[pos_x * 4 + 2],
-        new_view.children[pos_x * 4 + 3]
-    ]
-    for button in button_row:
-        new_view.remove_item(button)
+    # the clicked message shows the board before this move, whose layout is usually still cached
+    previous_layout = board_renderer.layout(selected_game)
 
     if selected_game.stage == 1:  # the last player selected a piece
         new_emoji_name = selected_game.pieces_matrix[pos_x][pos_y]
+        played_piece = 4 * pos_x + pos_y    # pieces are laid out like pieces_matrix
 
         sr = selected_game.select_stage(new_emoji_name)
         if sr == 2 or selected_game.is_board_full():  # the game is a draw
             await interaction.response.send_message("The game is a draw!")
-            del active_games[p1][p2]
-            if not active_games[p1]:
-                del active_games[p1]
+            delete_game(p1, p2, guild_id=interaction.guild_id)
             return
         elif sr == 1:  # game continues normally
             selected_game.change_stage()
             selected_game.next_turn()
+            storage.log_select(selected_game, new_emoji_name)
             view, content = send_board(p1, p2)
             # era qui!!!
 
@@ -196,19 +245,20 @@ async def on_interaction(interaction):
             return
 
     else:  # the last player selected a cell to place the piece
-        new_emoji_name = selected_game.last_selected_piece.label
+        played_piece = piece_indices[selected_game.last_selected_piece.code]
 
         vb, vc = selected_game.place_stage(pos_x, pos_y)
+        if vb >= 0:
+            storage.log_place(selected_game, pos_x, pos_y)
 
         if vb > 0:  # stop, game won
-            view, content = end_game_by_victory(selected_game, vb, vc)
+            view, content = end_game_by_victory(selected_game, vb, vc, guild_id=interaction.guild_id)
 
         elif vb == 0:  # game continues normally
             if selected_game.is_board_full():
                 await interaction.response.send_message("The game ended in a draw. Congratulations to both of you!")
-                del active_games[p1][p2]
-                if not active_games[p1]:
-                    del active_games[p1]
+                delete_game(p1, p2, guild_id=interaction.guild_id)
+                return
             selected_game.change_stage()
             view, content = send_board(p1, p2)
 
@@ -216,25 +266,25 @@ async def on_interaction(interaction):
             await interaction.response.send_message("You selected a non empty cell!")
             return
 
-    new_button = Button(
-        style=discord.ButtonStyle.green,
-        custom_id=f"{selected_game.id}_{p1}_{p2}_{selected_game.stage}_{pos_x}_{pos_y}",
-        disabled=True,
-        label=None,
-        emoji=f"<:{new_emoji_name}:{PieceEmoji[new_emoji_name].value}>",
-        row=pos_x
-    )
-    for i in range(4):
-        if i == pos_y:
-            new_view.add_item(new_button)
-        else:
-            new_view.add_item(button_row[i])
-
-    await previous_message.edit(view=new_view, content=previous_message.content)
+    if LIVE_BOARD:  # the clicked message becomes the new board, in the interaction response itself
+        await outbound.respond(
+            interaction.channel_id, lambda: interaction.response.edit_message(view=view, content=content)
+        )
+        return
 
-    await interaction.response.send_message(view=view, content=content)
-    message = await interaction.original_response()
-    selected_game.set_last_message(message)
+    previous_view = board_renderer.render_played(
+        previous_layout, selected_game.id, stage, target.cell, played_piece, on_interaction
+    )
+    # the previous board is edited from the message the interaction came with (its content is left as is), without
+    # fetching it, while the response with the new one is sent beside the channel's queue
+    previous_message = interaction.message
+    outbound.edit(interaction.channel_id, previous_message.id, lambda: previous_message.edit(view=previous_view))
+    response = await outbound.respond(
+        interaction.channel_id, lambda: interaction.response.send_message(view=view, content=content)
+    )
+    if selected_game.state == 0:    # a finished game was already deleted, and journaled as ended
+        message = response.resource or await interaction.original_response()
+        set_board_message(selected_game, message)
 
 
 @bot.command(pass_context=True, aliases=["h", "how", "howto", "bot", "quarto"])
@@ -249,13 +299,14 @@ async def help(context):
         
         **Game commands**
           • **challenge [quote someone]**: challenge the quoted player to a Quarto! game.
+          • **challenge [quote QuartoBot] [easy/medium/hard]**: play a practice game against the bot.
           • **accept [quote someone]**: accept the challenge the quoted player sent you and start the game.
           • **deny [quote someone]**: refuse the challenge the quoted player sent you.
           • **resume [quote someone]**: resend the board message of an active game between you and the quoted player.
           
         **Leaderboard commands**
-          • **top**: show the top 10 players by ELO (less if < 10 total players).
-          • **myrank**: show your position in the leaderboard.
+          • **top [global]**: show the top 10 players of this server by ELO, or of all servers.
+          • **myrank [global]**: show your position in the leaderboard of this server, or of all servers.
           
     """)
     help_embed = Embed(
@@ -296,7 +347,10 @@ async def rules(context):
 
 
 @bot.command(pass_context=True, aliases=["c", "chal", "play"])
-async def challenge(context, user: User):
+async def challenge(context, user: User, difficulty: str = "medium"):
+    if user.bot and user.id == bot.user.id:
+        await challenge_bot(context, difficulty.lower())
+        return
     if user.bot:
         await context.send("Come on, you cannot challenge a bot. Select a human as your worthy opponent!")
         return
@@ -322,31 +376,150 @@ async def accept(context, user: User):
     rival = context.message.author.id
     if challenger in pending_challenges and rival in pending_challenges[challenger]:
         first_to_start = choice([1, 2])
-        if challenger not in active_games:
-            active_games[challenger] = {rival: Game(challenger, rival, first_to_start)}
-        elif rival not in active_games[challenger]:
-            active_games[challenger][rival] = Game(challenger, rival, first_to_start)
-        else:
+        if active_games.has_pair(challenger, rival):
             await context.send(
                 f"You already have an unfinished game with <@{challenger}>. Finish it before starting a new one!")
             return
+        new_game = Game(challenger, rival, first_to_start)
+        active_games.add(new_game)
+        storage.log_new(new_game)
         pending_challenges[challenger].remove(rival)
         await context.send(f"<@{rival}> accepted your challenge, <@{challenger}>! The game will now begin.")
 
-        if challenger not in ratings:   # if the challenger has no ranking yet
-            ratings[challenger] = {"wins": 0, "losses": 0, "elo": 1000}
-
-        if rival not in ratings:   # if the rival has no ranking yet
-            ratings[rival] = {"wins": 0, "losses": 0, "elo": 1000}
+        ratings.add_player(challenger, rating_model.new_player())   # if the challenger has no ranking yet
+        ratings.add_player(rival, rating_model.new_player())        # if the rival has no ranking yet
+        update_leaderboard(challenger, rival)
+        if context.guild is not None:
+            guild_ratings.scope(context.guild.id).add_player(challenger, rating_model.new_player())
+            guild_ratings.scope(context.guild.id).add_player(rival, rating_model.new_player())
+            update_leaderboard(challenger, rival, guild_id=context.guild.id)
 
         view, content = send_board(challenger, rival)
         message = await context.send(view=view, content=content)
-        active_games[challenger][rival].set_last_message(message)
+        set_board_message(new_game, message)
 
     else:
         await context.send(f"<@{challenger}> never challenged you to a game!")
 
 
+async def challenge_bot(context, difficulty: str):
+    if difficulty not in ai.difficulties:
+        await context.send(f"I don't know that difficulty. Choose one of: {', '.join(ai.difficulties)}.")
+        return
+    challenger = context.message.author.id
+    rival = bot.user.id
+    if active_games.has_pair(challenger, rival):
+        await context.send("You already have an unfinished game with me. Finish it before starting a new one!")
+        return
+    new_game = Game(challenger, rival, choice([1, 2]))
+    new_game.set_difficulty(difficulty)
+    active_games.add(new_game)
+    storage.log_new(new_game)
+    await context.send(f"Challenge accepted, <@{challenger}>! This is a practice game ({difficulty}), it won't be rated.")
+
+    view, content = send_board(challenger, rival)
+    message = await context.send(view=view, content=content)
+    set_board_message(new_game, message)
+    await play_bot_turn(context.channel, challenger, rival)
+
+
+def bot_to_move(selected_game: Game) -> bool:
+    return selected_game.state == 0 and selected_game.get_players()[selected_game.turn - 1] == bot.user.id
+
+
+def bot_position(selected_game: Game) -> tuple:
+    # what a computed move depends on: it is only played if the game is still there when it comes back
+    return (selected_game.turn, selected_game.stage, selected_game.state, selected_game.remaining,
+            selected_game.last_selected_piece.label, selected_game.board.to_cells())
+
+
+async def play_bot_turn(channel, player_1, player_2):
+    if bot.user.id not in (player_1, player_2):
+        return
+    selected_game = active_games.get(player_1, player_2)
+    if selected_game is None or selected_game.id in bot_thinking:
+        return  # no game, or the bot is already computing its move
+    game_id = selected_game.id
+    bot_thinking.add(game_id)
+    try:
+        # the search runs in a worker process, so that the other games keep being served in the meantime
+        while bot_to_move(selected_game):
+            position = bot_position(selected_game)
+            difficulty = selected_game.difficulty or "medium"    # games saved before it was stored
+            cell, label = await asyncio.get_running_loop().run_in_executor(
+                ai_executor, ai_worker.compute_move, selected_game.to_bytes(), player_1, player_2, difficulty
+            )
+            async with game_locks.lock(game_id):
+                selected_game = active_games.by_id(game_id)
+                if selected_game is None:
+                    return  # the game was conceded while the bot was thinking
+                if bot_position(selected_game) == position:
+                    await play_bot_move(channel, player_1, player_2, selected_game, cell, label)
+                    return
+            # the game changed while the bot was thinking: the move is dropped, and computed again if it is still
+            # the bot's turn
+    finally:
+        bot_thinking.discard(game_id)
+
+
+async def play_bot_move(channel, player_1, player_2, selected_game: Game, cell: tuple[int, int], label: str):
+    if selected_game.stage == 2:    # place the piece, then select one for the opponent
+        vb, vc = selected_game.place_stage(*cell)
+        if vb < 0:  # the cell was not empty: the game is left as it was
+            print(f"Bot move rejected in game {selected_game.id}: cell {cell} is not empty")
+            return
+        storage.log_place(selected_game, *cell)
+        if vb > 0:
+            view, content = end_game_by_victory(selected_game, vb, vc)
+            await post_board(channel, selected_game, view, content, remember=False)
+            return
+        if selected_game.is_board_full():
+            await outbound.send(channel.id, lambda: channel.send("The game ended in a draw. Well played!"))
+            delete_game(player_1, player_2)
+            return
+        selected_game.change_stage()
+
+    sr = selected_game.select_stage(label)
+    if sr == 2 or selected_game.is_board_full():
+        await outbound.send(channel.id, lambda: channel.send("The game is a draw!"))
+        delete_game(player_1, player_2)
+        return
+    if sr == 0:     # the piece was already placed, or does not exist: the bot's turn ends here
+        print(f"Bot move rejected in game {selected_game.id}: piece {label} is not available")
+        return
+    selected_game.change_stage()
+    selected_game.next_turn()
+    storage.log_select(selected_game, label)
+    view, content = send_board(player_1, player_2)
+    await post_board(channel, selected_game, view, content)
+
+
+async def post_board(channel, selected_game: Game, view, content: str, remember: bool = True):
+    # shows a board without an interaction to respond to: edits the game's message with live boards, otherwise sends
+    # a new one (which becomes the game's message if remember)
+    if LIVE_BOARD and selected_game.last_message != "default":
+        board_message = channel.get_partial_message(int(selected_game.last_message))
+        outbound.edit(channel.id, board_message.id, lambda: board_message.edit(view=view, content=content))
+        return
+    message = await outbound.send(channel.id, lambda: channel.send(view=view, content=content))
+    if remember:
+        set_board_message(selected_game, message)
+
+
+def set_board_message(selected_game, message):
+    selected_game.set_last_message(message)
+    storage.log_message(selected_game)
+
+
+def delete_game(player_1, player_2, winner=None, victory_by: int = 0, victory_code: int = 0, guild_id: int = None,
+                rated: bool = False):
+    # the game is over: winner None for a draw, rated if it changed the ratings
+    selected_game = active_games.get(player_1, player_2)
+    storage.record_match(selected_game, winner, victory_by, victory_code, guild_id, rated)
+    storage.log_end(selected_game)
+    active_games.remove(player_1, player_2)
+
+
 @bot.command(pass_context=True, aliases=["d", "no"])
 async def deny(context, user: User):
     challenger = user.id
@@ -362,23 +535,23 @@ async def deny(context, user: User):
 async def resume(context, user: User):
     player_a = context.message.author.id
     player_b = user.id
-    if player_a not in active_games and player_b not in active_games:   # if none of them is in an active game
+    # if none of them is in an active game
+    if not active_games.has_player(player_a) and not active_games.has_player(player_b):
         await context.send("Neither of you is currently in an active game. Consider challenging each other!")
         return
-    if (player_a in active_games and player_b not in active_games[player_a])\
-            or (player_b in active_games and player_a not in active_games[player_b]):
+    selected_game = active_games.find(player_a, player_b)
+    if selected_game is None:
         await context.send("You don't have an active game with that user. Consider using q!challenge to start playing!")
         return
-    try:
-        challenger = player_a
-        rival = player_b
+    challenger, rival = selected_game.get_players()
+    game_id = selected_game.id
+    async with game_locks.lock(game_id):   # not while a move is being sent
+        selected_game = active_games.by_id(game_id)
+        if selected_game is None:
+            return  # the game ended in the meantime
         view, content = send_board(challenger, rival)
-    except KeyError:
-        challenger = player_b
-        rival = player_a
-        view, content = send_board(challenger, rival)
-    message = await context.send(view=view, content=content)
-    active_games[challenger][rival].set_last_message(message)
+        message = await context.send(view=view, content=content)
+        set_board_message(selected_game, message)
 
 
 @bot.command(pass_context=True, aliases=["forfeit", "ff", "surrender", "surr"])
@@ -386,51 +559,57 @@ async def concede(context, user: User):
     loser = context.message.author.id
     winner = user.id
     print("before if")
-    if loser not in active_games and winner not in active_games:   # if none of them is in an active game
+    # if none of them is in an active game
+    if not active_games.has_player(loser) and not active_games.has_player(winner):
         await context.send("You cannot concede a game that does not exist.")
         return
-    if (loser in active_games and winner not in active_games[loser])\
-            or (winner in active_games and loser not in active_games[winner]):
+    selected_game = active_games.find(loser, winner)
+    if selected_game is None:
         await context.send("You don't have an active game with that user. Consider using q!challenge to start playing!")
         return
     print("passed controls")
-    try:
-        selected_game = active_games[loser][winner]
-    except KeyError:
-        selected_game = active_games[winner][loser]
-    print("before end game by victory")
-    _, content = end_game_by_victory(selected_game, 5, 1, loser)
+    game_id = selected_game.id
+    async with game_locks.lock(game_id):   # not in the middle of a move
+        selected_game = active_games.by_id(game_id)
+        if selected_game is None:
+            return  # the game ended in the meantime
+        print("before end game by victory")
+        _, content = end_game_by_victory(
+            selected_game, 5, 1, loser, guild_id=context.guild.id if context.guild is not None else None
+        )
     await context.send(content)
 
 
 @bot.command(pass_context=True, aliases=["t", "rank", "leaderboard"])
-async def top(context):
+async def top(context, scope: str = "server"):
+    board = scoped_leaderboard(context, scope)
     embed = Embed(
-        title=f"Top {min(10, len(leaderboard))} players by ELO",
+        title=f"Top {min(10, len(board))} players by ELO",
         description="If you're not in here, you can use **q!myrank** to check your position!",
         color=0xffd700
     )
-    await print_leaderboard(context, embed, 1, 10)
+    await print_leaderboard(context, embed, board, 1, 10)
 
 
 @bot.command(pass_context=True, aliases=["me", "mypos", "myposition"])
-async def myrank(context):
+async def myrank(context, scope: str = "server"):
+    board = scoped_leaderboard(context, scope)
     user_id = context.message.author.id
-    if user_id not in leaderboard:
+    if user_id not in board:
         await context.send("You don't have a rank yet. Find an opponent to start playing!")
         return
-    user_pos = leaderboard.index(user_id)
+    user_pos = board.rank(user_id) - 1
     embed = Embed(
-        title=f"{context.guild.get_member(user_id).display_name}'s position in the leaderboard",
+        title=f"{context.message.author.display_name}'s position in the leaderboard",
         description=f"You are currently **#{user_pos+1}!**",
         color=0xffd700
     )
     if user_pos < 4:
-        await print_leaderboard(context, embed, 1, user_pos + 5)
-    elif user_pos > len(leaderboard) - 5:
-        await print_leaderboard(context, embed, user_pos - 3, len(leaderboard))
+        await print_leaderboard(context, embed, board, 1, user_pos + 5)
+    elif user_pos > len(board) - 5:
+        await print_leaderboard(context, embed, board, user_pos - 3, len(board))
     else:
-        await print_leaderboard(context, embed, user_pos - 3, user_pos + 5)
+        await print_leaderboard(context, embed, board, user_pos - 3, user_pos + 5)
 
 
 @bot.command(pass_context=True, aliases=["mystats", "wr"])
@@ -451,6 +630,8 @@ async def stats(context, *args: User):
         player_id = u.id
         if player_id in ratings:
             elo = str(ratings[player_id]["elo"])
+            if "rd" in ratings[player_id]:  # Glicko-2 deviation
+                elo += f" ±{round(ratings[player_id]['rd'])}"
             wins = str(ratings[player_id]["wins"])
             losses = str(ratings[player_id]["losses"])
             try:
@@ -472,21 +653,20 @@ async def stats(context, *args: User):
     await context.send(embed=embed)
 
 
-async def print_leaderboard(context, formatted_embed: Embed, start_pos: int = 1, end_pos: int = 1):
-    if len(leaderboard) == 0:             # if no players are present in the leaderboard
+async def print_leaderboard(context, formatted_embed: Embed, board: Leaderboard, start_pos: int = 1,
+                            end_pos: int = 1):
+    if len(board) == 0:             # if no players are present in the leaderboard
         await context.send("There is no player yet. You may be the first one!")
         return
     if start_pos > end_pos:
         return
 
     start_pos = max(1, start_pos)
-    end_pos = min(end_pos, len(leaderboard))
+    end_pos = min(end_pos, len(board))
     rank_list = [f"#{i}" for i in range(start_pos, end_pos + 1)]
-    name_list = [context.guild.get_member(m).display_name
-                 if context.guild.get_member(m) is not None else "Unknown player"
-                 for m in leaderboard[start_pos-1:end_pos]
-                 ]
-    elo_list = [f"{ratings[i]['elo']}" for i in leaderboard[start_pos-1:end_pos]]
+    ranked = board.players(start_pos, end_pos)
+    name_list = [player_name(context, m) for m in ranked]
+    elo_list = [f"{board.elo(i)}" for i in ranked]
 
     formatted_embed.add_field(
         name="Rank",
@@ -504,78 +684,43 @@ async def print_leaderboard(context, formatted_embed: Embed, start_pos: int = 1,
     await context.send(embed=formatted_embed)
 
 
-def update_leaderboard():
-    global leaderboard
-    try:
-        leaderboard = [int(i[0]) for i in sorted(ratings.items(), key=lambda x: x[1]["elo"], reverse=True)]
-    except (KeyError, IndexError):
-        return
+def player_name(context, user_id: int) -> str:
+    # members of the server first, then any user in the bot's cache (players of the global leaderboard)
+    user = context.guild.get_member(user_id) if context.guild is not None else None
+    if user is None:
+        user = bot.get_user(user_id)
+    return user.display_name if user is not None else "Unknown player"
+
+
+def scoped_leaderboard(context, scope: str = "server") -> Leaderboard:
+    # the leaderboard of the server the command comes from, or the global one (also used in direct messages)
+    if scope == "global" or context.guild is None:
+        return leaderboard
+    guild_id = context.guild.id
+    if guild_id not in guild_leaderboards:
+        guild_leaderboards[guild_id] = Leaderboard(guild_ratings.get(guild_id))
+    return guild_leaderboards[guild_id]
+
+
+def update_leaderboard(*user_ids, guild_id: int = None):
+    # moves the given players to their current rating, globally or in the server's leaderboard
+    if guild_id is None:
+        scope_ratings, board = ratings, leaderboard
+    elif guild_id in guild_leaderboards:
+        scope_ratings, board = guild_ratings.get(guild_id, {}), guild_leaderboards[guild_id]
+    else:
+        return  # built from guild_ratings when first shown
+    for user_id in user_ids:
+        if user_id in scope_ratings:
+            board.update(user_id, scope_ratings[user_id]["elo"])
 
 
 def send_board(player_1, player_2):
     print("before selected game")
-    print(f"total games: {active_games}")
-    print(f"games: {active_games[player_1]}")
-    selected_game = active_games[player_1][player_2]
-    print("before game board")
-    game_board = selected_game.board.board
-    view = View(timeout=None)
-    print("in send board: after view creation")
-    for i in range(len(game_board)):
-        for j in range(len(game_board)):
-            if selected_game.stage == 1:  # piece selection
-
-                emoji_name = selected_game.pieces_matrix[i][j]
-                emoji = f"<:{emoji_name}:{PieceEmoji[emoji_name].value}>"
-                label = None
-                disabled = selected_game.pieces.get(emoji_name) is None
-                if disabled:
-                    button_style = discord.ButtonStyle.red
-                else:
-                    button_style = discord.ButtonStyle.blurple
-            else:  # piece placement
-                emoji_name = PieceVal(game_board[i][j]).name
-                emoji = f"<:{emoji_name}:{PieceEmoji[emoji_name].value}>"
-                label = None
-                disabled = game_board[i][j] != 0
-                button_style = discord.ButtonStyle.gray
-
-            if selected_game.state == 1 or selected_game.state == 2:    # if the game is won
-                x, y = selected_game.last_xy
-                if selected_game.win_cond == 1:     # row
-                    if i == x:
-                        button_style = discord.ButtonStyle.green
-                    else:
-                        button_style = discord.ButtonStyle.gray
-                elif selected_game.win_cond == 2:   # col
-                    if j == y:
-                        button_style = discord.ButtonStyle.green
-                    else:
-                        button_style = discord.ButtonStyle.gray
-                elif selected_game.win_cond == 3:   # diag1
-                    if i == j:
-                        button_style = discord.ButtonStyle.green
-                    else:
-                        button_style = discord.ButtonStyle.gray
-                elif selected_game.win_cond == 4:   # diag2
-                    if i == 3 - j:
-                        button_style = discord.ButtonStyle.green
-                    else:
-                        button_style = discord.ButtonStyle.gray
-                else:
-                    button_style = discord.ButtonStyle.gray
-
-            button = Button(
-                style=button_style,
-                custom_id=f"{selected_game.id}_{player_1}_{player_2}_{selected_game.stage}_{i}_{j}",
-                disabled=disabled,
-                label=label,
-                emoji=emoji,
-                row=i
-            )
-            button.callback = on_interaction
-            view.add_item(button)
-    print("in send board: after double for loop")
+    print(f"total games: {len(active_games)} ({active_games.loaded} loaded)")
+    selected_game = active_games.get(player_1, player_2)
+    view = board_renderer.render(selected_game, on_interaction)
+    print("in send board: after rendering")
     if selected_game.turn == 1:
         whose_turn = player_1
     else:
@@ -594,7 +739,8 @@ def send_board(player_1, player_2):
     return view, content
 
 
-def end_game_by_victory(selected_game: Game, victory_by: int, victory_code: int, conceding_player=None):
+def end_game_by_victory(selected_game: Game, victory_by: int, victory_code: int, conceding_player=None,
+                        guild_id: int = None):
     if victory_by <= 0:
         return -1, -1
     print("passed victory by")
@@ -622,29 +768,43 @@ def end_game_by_victory(selected_game: Game, victory_by: int, victory_code: int,
             winner = p2
             loser = p1
     print("before try statement")
-    try:
+    if bot.user.id in (winner, loser):     # practice games against the bot are not rated
+        delete_game(p1, p2, winner, victory_by, victory_code, guild_id)
+        return view, content
+    rated = winner in ratings and loser in ratings
+    if not rated:
+        content += "\nThe ELO of the players could not be retrieved. The ratings won't be changed."
+
+    if rating_model.batched:    # rated with the other games of the period
+        pending_results.append((winner, loser, guild_id, rated))
+        if rated or guild_id is not None:
+            content += "\nThe ratings will be updated at the end of the rating period."
+        delete_game(p1, p2, winner, victory_by, victory_code, guild_id, rated)
+        return view, content
+
+    period = current_period()
+    if rated:
         r_winner = ratings[winner]["elo"]
         r_loser = ratings[loser]["elo"]
-        p_winner = elo.get_winning_probability(r_winner, r_loser)
-        p_loser = 1 - p_winner
-        next_winner = elo.get_next_rating(r_winner, p_winner, won=1)
-        next_loser = elo.get_next_rating(r_loser, p_loser, won=0)
-        content += f"\nYou won, <@{winner}>! Your rating increases from {r_winner} to {next_winner}"
-        content += f"\nYou lost, <@{loser}>! Your rating decreases from {r_loser} to {next_loser}"
-        print("after content in try")
-        ratings[winner]["elo"] = next_winner
-        ratings[winner]["wins"] += 1
-        ratings[loser]["elo"] = next_loser
-        ratings[loser]["losses"] += 1
-
-    except KeyError:
-        print("inside except statement")
-        content += "\nThe ELO of the players could not be retrieved. The ratings won't be changed."
-    del active_games[p1][p2]
-    if not active_games[p1]:
-        del active_games[p1]
-    update_leaderboard()
+        rate_results([(winner, loser)], period)
+        content += f"\nYou won, <@{winner}>! Your rating increases from {r_winner} to {ratings[winner]['elo']}"
+        content += f"\nYou lost, <@{loser}>! Your rating decreases from {r_loser} to {ratings[loser]['elo']}"
+
+    if guild_id is not None:    # the server's ratings only count the games played in it
+        server_ratings = guild_ratings.scope(guild_id)
+        server_ratings.add_player(winner, rating_model.new_player())
+        server_ratings.add_player(loser, rating_model.new_player())
+        r_winner = server_ratings[winner]["elo"]
+        r_loser = server_ratings[loser]["elo"]
+        rate_results([(winner, loser)], period, guild_id)
+        content += f"\nOn this server: <@{winner}> {r_winner} → {server_ratings[winner]['elo']}, " \
+                   f"<@{loser}> {r_loser} → {server_ratings[loser]['elo']}"
+
+    delete_game(p1, p2, winner, victory_by, victory_code, guild_id, rated)
     return view, content
 
 
-bot.run(TOKEN)
+if __name__ == "__main__":   # worker processes of ai_executor import this module as "__mp_main__"
+    with open(absolute_token, "r") as f:
+        TOKEN = f.readline()
+    bot.run(TOKEN)
@@ -0,0 +1,152 @@
+import asyncio
+from collections import deque
+
+# Outbound Discord calls of the game flow. Interaction responses are sent at once, beside the channel queues: Discord
+# drops them after 3 seconds, so they never wait behind a call that is sleeping on the channel's rate limit. The other
+# calls are queued per channel and sent one at a time, new messages before edits of older boards, which are only
+# cosmetic. An edit of a message that already has one waiting replaces it, as only the latest board matters: both
+# callers get the result of the one that is sent.
+# Calls are zero-argument coroutine functions (e.g. lambda: message.edit(view=view)), sent by sender(request), which
+# awaits request.action() unless another sender is given (e.g. a local stand-in for the Discord API).
+
+RESPONSE = 0
+SEND = 1
+EDIT = 2
+
+
+class OutboundRequest:
+    __slots__ = ("channel_id", "priority", "key", "action", "futures")
+
+    def __init__(self, channel_id: int, priority: int, key, action, future: asyncio.Future):
+        self.channel_id = channel_id
+        self.priority = priority
+        self.key = key              # message id of an edit, None for calls that are never coalesced
+        self.action = action
+        self.futures = [future]     # one per caller, several when edits were coalesced
+
+
+class OutboundMetrics:
+    def __init__(self):
+        self.depth = 0              # requests waiting, in all channels
+        self.max_depth = 0
+        self.sent = 0
+        self.coalesced = 0          # edits replaced by a later one before being sent
+        self.failed = 0
+
+    def __str__(self):
+        return (f"{self.depth} waiting (max {self.max_depth}), {self.sent} sent, {self.coalesced} coalesced, "
+                f"{self.failed} failed")
+
+
+def send_action(request: OutboundRequest):
+    return request.action()
+
+
+def report_failure(future: asyncio.Future):
+    # for edits nobody awaits
+    if not future.cancelled() and future.exception() is not None:
+        print(f"outbound edit failed: {future.exception()!r}")
+
+
+class OutboundScheduler:
+    def __init__(self, sender=send_action):
+        self.__sender = sender
+        self.__queues = {}          # channel_id -> (new messages, edits), deques of OutboundRequest
+        self.__edits = {}           # (channel_id, message id) -> edit not sent yet
+        self.__workers = {}         # channel_id -> task draining its queue, while it is not empty
+        self.__responses = set()    # tasks sending an interaction response
+        self.metrics = OutboundMetrics()
+
+    def depth(self, channel_id: int = None) -> int:
+        # requests waiting in the channel, or in all of them
+        if channel_id is None:
+            return self.metrics.depth
+        return sum(len(queue) for queue in self.__queues.get(channel_id, ()))
+
+    def channels(self) -> int:
+        return len(self.__queues)
+
+    def respond(self, channel_id: int, action) -> asyncio.Future:
+        return self.submit(channel_id, action, RESPONSE)
+
+    def send(self, channel_id: int, action) -> asyncio.Future:
+        return self.submit(channel_id, action, SEND)
+
+    def edit(self, channel_id: int, message_id: int, action) -> asyncio.Future:
+        future = self.submit(channel_id, action, EDIT, message_id)
+        future.add_done_callback(report_failure)
+        return future
+
+    def submit(self, channel_id: int, action, priority: int = SEND, key=None) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if priority == RESPONSE:
+            task = loop.create_task(self.__send(OutboundRequest(channel_id, priority, None, action, future)))
+            self.__responses.add(task)
+            task.add_done_callback(self.__responses.discard)
+            return future
+
+        if key is not None and (channel_id, key) in self.__edits:    # superseded before being sent
+            request = self.__edits[(channel_id, key)]
+            request.action = action
+            request.futures.append(future)
+            self.metrics.coalesced += 1
+            return future
+
+        request = OutboundRequest(channel_id, priority, key, action, future)
+        if key is not None:
+            self.__edits[(channel_id, key)] = request
+        if channel_id not in self.__queues:
+            self.__queues[channel_id] = (deque(), deque())
+        self.__queues[channel_id][priority - SEND].append(request)
+        self.metrics.depth += 1
+        self.metrics.max_depth = max(self.metrics.max_depth, self.metrics.depth)
+        if channel_id not in self.__workers:
+            self.__workers[channel_id] = loop.create_task(self.__drain(channel_id))
+        return future
+
+    async def close(self):
+        # cancels whatever was not sent yet, e.g. when the bot shuts down
+        tasks = [*self.__workers.values(), *self.__responses]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __send(self, request: OutboundRequest):
+        try:
+            result = await self.__sender(request)
+        except asyncio.CancelledError:
+            for future in request.futures:
+                future.cancel()
+            raise
+        except Exception as error:
+            self.metrics.failed += 1
+            for future in request.futures:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            self.metrics.sent += 1
+            for future in request.futures:
+                if not future.done():
+                    future.set_result(result)
+
+    async def __drain(self, channel_id: int):
+        queues = self.__queues[channel_id]
+        try:
+            while True:
+                request = next((queue.popleft() for queue in queues if queue), None)
+                if request is None:
+                    break
+                self.metrics.depth -= 1
+                if request.key is not None:
+                    del self.__edits[(channel_id, request.key)]
+                await self.__send(request)
+        finally:    # empty, or cancelled: whatever is left will not be sent
+            for queue in queues:
+                for request in queue:
+                    self.metrics.depth -= 1
+                    self.__edits.pop((channel_id, request.key), None)
+                    for future in request.futures:
+                        future.cancel()
+            del self.__queues[channel_id]
+            del self.__workers[channel_id]
@@ -0,0 +1,158 @@
+from abc import ABC, abstractmethod
+from math import ceil, exp, log, pi, sqrt
+
+import elo
+
+# Rating models update a RatingsStore (user_id -> {"wins", "losses", "elo", ...}) from a list of (winner, loser)
+# results. "elo" always holds the displayed rating, used by the leaderboards; models may keep more state in the same
+# dict (Glicko-2 adds "rating", "rd", "vol" and "period").
+# Models with batched = True are meant to rate the games of a whole rating period at once (see main.rating_period),
+# the others can rate every game as soon as it ends.
+
+
+class RatingModel(ABC):
+    name = ""
+    batched = False
+
+    @abstractmethod
+    def new_player(self) -> dict:
+        ...
+
+    @abstractmethod
+    def rate(self, ratings, results: list[tuple[int, int]], period: int = 0) -> set[int]:
+        # updates the ratings in place from the results of one rating period; returns the players who changed
+        ...
+
+
+class EloModel(RatingModel):
+    # the fixed K-factor Elo of elo.py, one game at a time in the order they were played
+    name = "elo"
+
+    def __init__(self, k: int = 32, initial: int = 1000):
+        self.k = k
+        self.initial = initial
+
+    def new_player(self) -> dict:
+        return {"wins": 0, "losses": 0, "elo": self.initial}
+
+    def rate(self, ratings, results: list[tuple[int, int]], period: int = 0) -> set[int]:
+        changed = set()
+        for winner, loser in results:
+            for user_id in (winner, loser):
+                if user_id not in ratings:
+                    ratings[user_id] = self.new_player()
+            r_winner = ratings[winner]["elo"]
+            r_loser = ratings[loser]["elo"]
+            p_winner = elo.get_winning_probability(r_winner, r_loser)
+            # same as elo.get_next_rating, with this model's K-factor
+            ratings[winner]["elo"] = r_winner + int(ceil(self.k * (1 - p_winner)))
+            ratings[winner]["wins"] += 1
+            ratings[loser]["elo"] = r_loser + int(ceil(self.k * (p_winner - 1)))
+            ratings[loser]["losses"] += 1
+            changed.update((winner, loser))
+        ratings.mark_changed(*changed)
+        return changed
+
+
+GLICKO_SCALE = 173.7178
+
+
+class Glicko2Model(RatingModel):
+    # Glickman's Glicko-2: every player has a rating, a rating deviation (how uncertain the rating is) and a
+    # volatility (how erratic their results are). All the games of a rating period are rated together, from the
+    # ratings at the start of the period. The deviation of players who did not play grows by one step per idle
+    # period; it is applied when they play again, so idle players cost nothing.
+    name = "glicko2"
+    batched = True
+
+    def __init__(self, tau: float = 0.5, initial: float = 1000, initial_rd: float = 350, initial_vol: float = 0.06):
+        self.tau = tau
+        self.initial = initial
+        self.initial_rd = initial_rd
+        self.initial_vol = initial_vol
+
+    def new_player(self) -> dict:
+        return {"wins": 0, "losses": 0, "elo": round(self.initial), "rating": self.initial, "rd": self.initial_rd,
+                "vol": self.initial_vol, "period": None}
+
+    def __state(self, rating: dict, period: int) -> (float, float, float):
+        # (mu, phi, volatility) on the Glicko-2 scale at the start of the period. Players rated with another model
+        # start from their displayed rating and the initial deviation
+        r = rating.get("rating", rating["elo"])
+        phi = rating.get("rd", self.initial_rd) / GLICKO_SCALE
+        vol = rating.get("vol", self.initial_vol)
+        last = rating.get("period")
+        if last is not None and period - last > 1:    # idle periods in between
+            phi = min(sqrt(phi * phi + (period - last - 1) * vol * vol), self.initial_rd / GLICKO_SCALE)
+        return (r - 1500) / GLICKO_SCALE, phi, vol
+
+    def __volatility(self, phi: float, vol: float, v: float, delta: float) -> float:
+        # Illinois algorithm, step 5 of Glickman's paper
+        a = log(vol * vol)
+        tau = self.tau
+
+        def f(x):
+            ex = exp(x)
+            return ex * (delta * delta - phi * phi - v - ex) / (2 * (phi * phi + v + ex) ** 2) - (x - a) / (tau * tau)
+
+        big_a = a
+        if delta * delta > phi * phi + v:
+            big_b = log(delta * delta - phi * phi - v)
+        else:
+            k = 1
+            while f(a - k * tau) < 0:
+                k += 1
+            big_b = a - k * tau
+        f_a, f_b = f(big_a), f(big_b)
+        while abs(big_b - big_a) > 1e-6:
+            big_c = big_a + (big_a - big_b) * f_a / (f_b - f_a)
+            f_c = f(big_c)
+            if f_c * f_b <= 0:
+                big_a, f_a = big_b, f_b
+            else:
+                f_a /= 2
+            big_b, f_b = big_c, f_c
+        return exp(big_a / 2)
+
+    def rate(self, ratings, results: list[tuple[int, int]], period: int = 0) -> set[int]:
+        games = {}      # user_id -> [(opponent, score)]
+        for winner, loser in results:
+            for user_id in (winner, loser):
+                if user_id not in ratings:
+                    ratings[user_id] = self.new_player()
+            games.setdefault(winner, []).append((loser, 1.0))
+            games.setdefault(loser, []).append((winner, 0.0))
+        states = {user_id: self.__state(ratings[user_id], period) for user_id in games}
+
+        new_states = {}
+        for user_id, played in games.items():
+            mu, phi, vol = states[user_id]
+            v_inverse = 0.0
+            improvement = 0.0
+            for opponent, score in played:
+                mu_j, phi_j, _ = states[opponent]
+                g = 1 / sqrt(1 + 3 * phi_j * phi_j / (pi * pi))
+                expected = 1 / (1 + exp(-g * (mu - mu_j)))
+                v_inverse += g * g * expected * (1 - expected)
+                improvement += g * (score - expected)
+            v = 1 / v_inverse
+            new_vol = self.__volatility(phi, vol, v, v * improvement)
+            phi_star = sqrt(phi * phi + new_vol * new_vol)
+            new_phi = 1 / sqrt(1 / (phi_star * phi_star) + 1 / v)
+            new_states[user_id] = (mu + new_phi * new_phi * improvement, new_phi, new_vol)
+
+        for user_id, (mu, phi, vol) in new_states.items():
+            rating = ratings[user_id]
+            rating["rating"] = GLICKO_SCALE * mu + 1500
+            rating["rd"] = GLICKO_SCALE * phi
+            rating["vol"] = vol
+            rating["period"] = period
+            rating["elo"] = round(rating["rating"])
+        for winner, loser in results:
+            ratings[winner]["wins"] += 1
+            ratings[loser]["losses"] += 1
+        ratings.mark_changed(*games.keys())
+        return set(games.keys())
+
+
+models = {model.name: model for model in (EloModel, Glicko2Model)}
@@ -0,0 +1,127 @@
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from storage import GuildRatings, RatingsStore, open_storage
+
+# Rebuilds the ratings from the match history, with the same update as end_game_by_victory.
+# The rated matches are turned into arrays, in the order they ended:
+#   winners, losers  (M,) int64   dense index of each player (see user_ids)
+# Elo updates of one player must happen in order, but matches without a common player are independent: every match
+# goes to the layer right after the last layer of both its players, and a whole layer is updated at once.
+
+
+def match_arrays(matches: list[dict], excluded: set = ()) -> (np.ndarray, np.ndarray, np.ndarray):
+    # (user_ids, winners, losers) of the rated matches, matches being sorted by end time
+    rated = [
+        (m["winner"], m["player_2"] if m["winner"] == m["player_1"] else m["player_1"])
+        for m in matches
+        if m["rated"] and m["winner"] is not None and m["player_1"] not in excluded and m["player_2"] not in excluded
+    ]
+    if not rated:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    pairs = np.array(rated, dtype=np.int64)
+    user_ids, indices = np.unique(pairs, return_inverse=True)
+    indices = indices.reshape(pairs.shape)
+    return user_ids, indices[:, 0], indices[:, 1]
+
+
+def match_layers(winners: np.ndarray, losers: np.ndarray, players: int) -> np.ndarray:
+    # (M,) layer of every match: one more than the last layer of either player
+    last = [-1] * players
+    layers = np.empty(len(winners), dtype=np.int64)
+    for i, (winner, loser) in enumerate(zip(winners.tolist(), losers.tolist())):
+        layer = max(last[winner], last[loser]) + 1
+        last[winner] = last[loser] = layer
+        layers[i] = layer
+    return layers
+
+
+def replay_elo(winners: np.ndarray, losers: np.ndarray, players: int, k: float = 32,
+               initial: int = 1000) -> (np.ndarray, np.ndarray, np.ndarray):
+    # (elo, wins, losses) of every player after all the matches
+    elo = np.full(players, initial, dtype=np.int64)
+    wins = np.bincount(winners, minlength=players)
+    losses = np.bincount(losers, minlength=players)
+    if not len(winners):
+        return elo, wins, losses
+
+    layers = match_layers(winners, losers, players)
+    order = np.argsort(layers, kind="stable")
+    bounds = np.flatnonzero(np.diff(layers[order])) + 1
+    for layer in np.split(order, bounds):
+        w, lo = winners[layer], losers[layer]
+        r_winner, r_loser = elo[w], elo[lo]
+        # elo.get_winning_probability(r_winner, r_loser), as used by end_game_by_victory
+        p_winner = 1.0 / (1.0 + 10.0 ** ((r_winner - r_loser) / 400.0))
+        elo[w] = r_winner + np.ceil(k * (1 - p_winner)).astype(np.int64)
+        elo[lo] = r_loser + np.ceil(k * (p_winner - 1)).astype(np.int64)
+    return elo, wins, losses
+
+
+def recompute_ratings(matches: list[dict], k: float = 32, initial: int = 1000, excluded: set = ()) -> RatingsStore:
+    user_ids, winners, losers = match_arrays(matches, excluded)
+    elo, wins, losses = replay_elo(winners, losers, len(user_ids), k, initial)
+    return RatingsStore({
+        user_id: {"wins": w, "losses": lo, "elo": e}
+        for user_id, e, w, lo in zip(user_ids.tolist(), elo.tolist(), wins.tolist(), losses.tolist())
+    })
+
+
+def recompute_guild_ratings(matches: list[dict], k: float = 32, initial: int = 1000,
+                            excluded: set = ()) -> GuildRatings:
+    by_guild = {}
+    for match in matches:
+        if match["guild_id"] is not None:
+            by_guild.setdefault(match["guild_id"], []).append(match)
+    return GuildRatings({
+        guild_id: recompute_ratings(guild_matches, k, initial, excluded) for guild_id, guild_matches in by_guild.items()
+    })
+
+
+def compare(stored: dict[int, dict], rebuilt: dict[int, dict]) -> list[tuple[int, int, int]]:
+    # (user_id, stored elo, rebuilt elo) of the players whose rating differs
+    return [
+        (user_id, stored.get(user_id, {}).get("elo"), rebuilt.get(user_id, {}).get("elo"))
+        for user_id in sorted(stored.keys() | rebuilt.keys())
+        if stored.get(user_id, {}).get("elo") != rebuilt.get(user_id, {}).get("elo")
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the Quarto ratings from the match history.")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--db", default=None, help="sqlite database path")
+    parser.add_argument("--k", type=float, default=32, help="K-factor")
+    parser.add_argument("--initial", type=int, default=1000)
+    parser.add_argument("--exclude", type=int, nargs="*", default=[], help="user ids to leave out (e.g. the bot)")
+    parser.add_argument("--write", action="store_true", help="replace the stored ratings")
+    args = parser.parse_args()
+
+    storage = open_storage(args.storage, args.db)
+    matches = storage.load_matches()
+    start = perf_counter()
+    ratings = recompute_ratings(matches, args.k, args.initial, set(args.exclude))
+    guild_ratings = recompute_guild_ratings(matches, args.k, args.initial, set(args.exclude))
+    elapsed = perf_counter() - start
+    print(f"{len(matches)} matches replayed in {elapsed:.2f}s: {len(ratings)} players, {len(guild_ratings)} servers.")
+
+    differences = compare(storage.load_ratings(), ratings)
+    storage.load_guild_ratings()
+    print(f"{len(differences)} players with a different global rating.")
+    for user_id, stored, rebuilt in differences[:20]:
+        print(f"  {user_id}: {stored} -> {rebuilt}")
+
+    if args.write:
+        ratings.mark_changed(*ratings.keys())
+        for guild in guild_ratings.values():
+            guild.mark_changed(*guild.keys())
+        storage.flush(storage.load_games(), ratings, guild_ratings)
+        print("ratings written.")
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from victory import lines, line_types, win_codes
+
+# B games are played in lockstep as arrays:
+#   cells      (B, 16) int8    piece index on each cell, -1 when empty
+#   remaining  (B, 16) bool    pieces that can still be selected
+#   hand       (B,)    int8    piece to place this turn
+#   turn       (B,)    int8    1 or 2, the player placing this turn
+#   result     (B,)    int8    0 in progress, 1/2 won by that player, 3 draw
+# Win checks follow Board.check_victory: a full line wins when all its pieces share an attribute bit, either set
+# (AND of the piece indices) or cleared (AND of their complements).
+
+line_cells = np.array(lines, dtype=np.intp)                     # (10, 4)
+line_victory_by = np.array(line_types, dtype=np.int8)           # (10,)
+victory_table = np.array(win_codes, dtype=np.int8)              # (256,)
+# completing[i, p]: piece p completes a 3-piece line whose shared set/cleared bits are (i >> 4, i & 0xF)
+completing = np.array(
+    [[bool(p & (i >> 4) or ~p & i & 0xF) for p in range(16)] for i in range(256)], dtype=bool
+)
+
+
+def line_codes(cells: np.ndarray) -> np.ndarray:
+    # (B, 10) victory codes of every line, 0 for lines that are not full or not winning
+    line_pieces = cells[:, line_cells]                          # (B, 10, 4)
+    full = (line_pieces >= 0).all(axis=2)
+    pieces = np.where(line_pieces >= 0, line_pieces, 0).astype(np.uint8)
+    ones = np.bitwise_and.reduce(pieces, axis=2)
+    zeros = np.bitwise_and.reduce(~pieces & 0xF, axis=2)
+    return np.where(full, victory_table[(ones << 4) | zeros], 0)
+
+
+def check_victories(cells: np.ndarray, placed: np.ndarray) -> (np.ndarray, np.ndarray):
+    # (victory_by, victory_code) of the lines through the cell placed in each game, like Board.check_victory
+    codes = line_codes(cells)
+    through = (line_cells[None, :, :] == placed[:, None, None]).any(axis=2)    # (B, 10)
+    winning = (codes > 0) & through
+    first = winning.argmax(axis=1)      # rows come before cols, cols before diagonals
+    has_win = winning.any(axis=1)
+    rows = np.arange(len(cells))
+    return np.where(has_win, line_victory_by[first], 0), np.where(has_win, codes[rows, first], 0)
+
+
+def open_lines(cells: np.ndarray) -> (np.ndarray, np.ndarray):
+    # for the lines holding exactly 3 pieces: (B, 10, 16) the pieces that complete them, (B, 10) their empty cell
+    line_pieces = cells[:, line_cells]
+    filled = line_pieces >= 0
+    three = filled.sum(axis=2) == 3
+    pieces = line_pieces.astype(np.uint8)
+    ones = np.bitwise_and.reduce(np.where(filled, pieces, 0xF), axis=2)
+    zeros = np.bitwise_and.reduce(np.where(filled, ~pieces & 0xF, 0xF), axis=2)
+    completers = completing[(ones << 4) | zeros] & three[:, :, None]
+    empty_cell = line_cells[np.arange(10)[None, :], np.argmax(~filled, axis=2)]
+    return completers, empty_cell
+
+
+def killer_mask(cells: np.ndarray) -> np.ndarray:
+    # (B, 16) pieces that would let the next player win right away
+    return open_lines(cells)[0].any(axis=1)
+
+
+def winning_cells(cells: np.ndarray, hand: np.ndarray) -> np.ndarray:
+    # (B, 16) empty cells where placing the piece in hand completes a winning line
+    completers, empty_cell = open_lines(cells)
+    wins = completers[np.arange(len(cells))[:, None], np.arange(10)[None, :], hand[:, None]]     # (B, 10)
+    result = np.zeros(cells.shape, dtype=bool)
+    game_rows, line_rows = np.nonzero(wins)
+    result[game_rows, empty_cell[game_rows, line_rows]] = True
+    return result
+
+
+def random_choice(mask: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    # index of a uniformly chosen True entry in each row (rows must not be empty)
+    scores = np.where(mask, rng.random(mask.shape), -1.0)
+    return scores.argmax(axis=1)
+
+
+class Simulator:
+    def __init__(self, batch: int, policy: str = "random", seed=None):
+        if policy not in ("random", "greedy"):
+            raise Exception(f"Unknown policy {policy}")
+        self.__batch = batch
+        self.__policy = policy
+        self.__rng = np.random.default_rng(seed)
+
+    @property
+    def batch(self):
+        return self.__batch
+
+    @property
+    def policy(self):
+        return self.__policy
+
+    def play(self) -> dict[str, np.ndarray]:
+        batch, rng = self.__batch, self.__rng
+        rows = np.arange(batch)
+        cells = np.full((batch, 16), -1, dtype=np.int8)
+        remaining = np.ones((batch, 16), dtype=bool)
+        first_player = rng.integers(1, 3, size=batch, dtype=np.int8)
+        result = np.zeros(batch, dtype=np.int8)
+        victory_by = np.zeros(batch, dtype=np.int8)
+        victory_code = np.zeros(batch, dtype=np.int8)
+
+        # the first player selects a piece for the second one
+        hand = random_choice(remaining, rng).astype(np.int8)
+        remaining[rows, hand] = False
+        turn = (3 - first_player).astype(np.int8)
+
+        for _ in range(16):
+            active = result == 0
+            if not active.any():
+                break
+            empty = cells < 0
+            if self.__policy == "greedy":
+                # place where the piece wins, if anywhere
+                winning = winning_cells(cells, hand)
+                choose_from = np.where(winning.any(axis=1)[:, None], winning, empty)
+            else:
+                choose_from = empty
+            choose_from = choose_from | ~active[:, None]  # finished games keep a dummy (ignored) choice
+            placed = random_choice(choose_from, rng)
+
+            placing = rows[active]
+            cells[placing, placed[active]] = hand[active]
+            vb, vc = check_victories(cells, placed)
+            won = active & (vb > 0)
+            result[won] = turn[won]
+            victory_by[won], victory_code[won] = vb[won], vc[won]
+
+            no_pieces = ~remaining.any(axis=1)
+            result[active & ~won & no_pieces] = 3
+
+            selecting = result == 0
+            if not selecting.any():
+                break
+            candidates = remaining
+            if self.__policy == "greedy":  # avoid handing over a winning piece, unless all of them are
+                safe = remaining & ~killer_mask(cells)
+                candidates = np.where(safe.any(axis=1)[:, None], safe, remaining)
+            candidates = candidates | ~selecting[:, None]
+            next_hand = random_choice(candidates, rng).astype(np.int8)
+            remaining[rows[selecting], next_hand[selecting]] = False
+            hand = np.where(selecting, next_hand, hand)
+            turn = np.where(selecting, 3 - turn, turn).astype(np.int8)
+
+        return {
+            "cells": cells,
+            "first_player": first_player,
+            "result": result,
+            "victory_by": victory_by,
+            "victory_code": victory_code,
+        }
+
+
+def summarize(outcome: dict[str, np.ndarray]) -> dict[str, float]:
+    result, first_player = outcome["result"], outcome["first_player"]
+    games = len(result)
+    won_by_first = (result == first_player).sum()
+    draws = (result == 3).sum()
+    return {
+        "games": games,
+        "first_player_wins": won_by_first / games,
+        "second_player_wins": (games - won_by_first - draws) / games,
+        "draws": draws / games,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched Quarto self-play simulator.")
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=10000)
+    parser.add_argument("--policy", choices=["random", "greedy"], default="random")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    simulator = Simulator(args.batch, args.policy, args.seed)
+    totals = {"games": 0, "first_player_wins": 0.0, "second_player_wins": 0.0, "draws": 0.0}
+    start = perf_counter()
+    while totals["games"] < args.games:
+        stats = summarize(simulator.play())
+        for key in ("first_player_wins", "second_player_wins", "draws"):
+            totals[key] += stats[key] * stats["games"]
+        totals["games"] += stats["games"]
+    elapsed = perf_counter() - start
+
+    games = totals["games"]
+    print(f"{games} {args.policy} games in {elapsed:.2f}s: {games / elapsed:.0f} games/s")
+    print(f"first player wins: {totals['first_player_wins'] / games:.2%}")
+    print(f"second player wins: {totals['second_player_wins'] / games:.2%}")
+    print(f"draws: {totals['draws'] / games:.2%}")
+
+
+if __name__ == "__main__":
+    main()
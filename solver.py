@@ -0,0 +1,320 @@
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+from bitboard import plane_bits
+from canonical import canonical_form
+from game import Game, piece_indices, piece_labels
+from victory import line_masks
+
+# a position is searched from the point of view of the player who has to place a piece:
+# values are 1 (win), 0 (draw) and -1 (loss), and a move is the placement plus the piece given to the opponent
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# pieces that complete a line whose 3 pieces share the attribute bits "ones" (set) and "zeros" (cleared)
+completing = [
+    sum(1 << p for p in range(16) if p & (i >> 4) or ~p & i & 0xF) for i in range(256)
+]
+
+
+class SearchBudgetExceeded(Exception):
+    pass
+
+
+class SolveResult(NamedTuple):
+    value: int                      # 1 win, 0 draw, -1 loss, for the player whose turn it is
+    cell: Optional[tuple]           # (pos_x, pos_y) to place the selected piece on, None in the selection stage
+    piece: Optional[str]            # label of the piece to give to the opponent, None if the game ends
+    complete: bool                  # False if the budget ran out: value and move are the best found so far (0 if none)
+    nodes: int
+    elapsed: float
+
+
+class TranspositionTable:
+    def __init__(self, capacity: int = 1 << 20):
+        self.__capacity = capacity
+        self.__entries = {}
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key: int):
+        return self.__entries.get(key)
+
+    def store(self, key: int, value: int, flag: int, move):
+        entries = self.__entries
+        if key not in entries and len(entries) >= self.__capacity:
+            del entries[next(iter(entries))]    # evict the oldest entry
+        entries[key] = (value, flag, move)
+
+    def clear(self):
+        self.__entries.clear()
+
+
+def threats(occupied: int, planes: int) -> list[tuple[int, int]]:
+    # (empty cell bit, mask of the winning pieces) for every line that holds exactly 3 pieces
+    result = []
+    for mask in line_masks:
+        filled = occupied & mask
+        if filled.bit_count() != 3:
+            continue
+        ones = zeros = 0
+        for bit in range(4):
+            plane = (planes >> (16 * bit)) & mask
+            if plane == filled:
+                ones |= 1 << bit
+            elif plane == 0:
+                zeros |= 1 << bit
+        killers = completing[ones << 4 | zeros]
+        if killers:
+            result.append((mask ^ filled, killers))
+    return result
+
+
+def killer_pieces(occupied: int, planes: int) -> int:
+    # mask of the pieces that would let the next player win immediately
+    killers = 0
+    for _, pieces in threats(occupied, planes):
+        killers |= pieces
+    return killers
+
+
+def cell_of(cell_bit: int) -> int:
+    return cell_bit.bit_length() - 1
+
+
+def cells_of(occupied: int, planes: int) -> list[int]:
+    return [
+        sum((planes >> (16 * bit + cell) & 1) << bit for bit in range(4)) if occupied >> cell & 1 else -1
+        for cell in range(16)
+    ]
+
+
+class Solver:
+    def __init__(self, table: TranspositionTable = None, canonical_empty: int = 10):
+        self.__table = TranspositionTable() if table is None else table
+        # positions with at least this many empty cells are stored under their symmetry-canonical key, so that all
+        # equivalent positions share one entry (None to always use the raw position key)
+        self.__canonical_empty = canonical_empty
+        self.__nodes = 0
+        self.__max_nodes = None
+        self.__deadline = None
+
+    @property
+    def table(self):
+        return self.__table
+
+    def solve(self, game: Game, max_nodes: int = None, time_limit: float = None, hint=None) -> SolveResult:
+        if game.state in (1, 2):
+            value = 1 if game.state == game.turn else -1
+            return SolveResult(value, None, None, True, 0, 0.0)
+        if game.state == 3:
+            return SolveResult(0, None, None, True, 0, 0.0)
+
+        piece = piece_indices[game.last_selected_piece.code] if game.stage == 2 else -1
+        return self.solve_position(game.board.to_cells(), piece, game.remaining, max_nodes, time_limit, hint)
+
+    def solve_position(self, cells: list[int], piece: int = -1, remaining: int = None,
+                       max_nodes: int = None, time_limit: float = None, hint=None) -> SolveResult:
+        # cells hold piece indices (-1 for empty), piece is the one to place (-1 in the selection stage), and
+        # remaining defaults to all the pieces that are neither on the board nor in hand.
+        # hint is a move searched first, e.g. from an opening book: (cell, piece given) when placing, the piece index
+        # when selecting. It is also the move returned if the budget runs out before anything was searched
+        start = perf_counter()
+        self.__nodes = 0
+        self.__max_nodes = max_nodes
+        self.__deadline = None if time_limit is None else start + time_limit
+
+        occupied = planes = 0
+        for cell, p in enumerate(cells):
+            if p >= 0:
+                occupied |= 1 << cell
+                planes |= plane_bits[p][cell]
+        if remaining is None:
+            remaining = 0xFFFF & ~sum(1 << p for p in cells if p >= 0) & ~(1 << piece if piece >= 0 else 0)
+
+        if piece >= 0:
+            value, move, complete = self.__root_place(piece, occupied, planes, remaining, hint)
+            cell, next_piece = move
+            cell_xy = (cell // 4, cell % 4)
+        else:
+            value, next_piece, complete = self.__root_select(occupied, planes, remaining, hint)
+            cell_xy = None
+        label = None if next_piece is None else piece_labels[next_piece]
+        return SolveResult(value, cell_xy, label, complete, self.__nodes, perf_counter() - start)
+
+    def __count_node(self):
+        self.__nodes += 1
+        if self.__nodes & 0xFF == 0:
+            if self.__max_nodes is not None and self.__nodes >= self.__max_nodes:
+                raise SearchBudgetExceeded
+            if self.__deadline is not None and perf_counter() >= self.__deadline:
+                raise SearchBudgetExceeded
+
+    def __root_select(self, occupied: int, planes: int, remaining: int, hint: int = None):
+        if not remaining:
+            return 0, None, True
+        killers = killer_pieces(occupied, planes)
+        safe = remaining & ~killers
+        candidates = [p for p in range(16) if safe >> p & 1]
+        if not candidates:     # every piece lets the opponent win
+            return -1, cell_of(remaining & -remaining), True
+        if hint in candidates:
+            candidates.remove(hint)
+            candidates.insert(0, hint)
+        best_value, best_piece = -2, candidates[0]
+        try:
+            for p in candidates:
+                value = -self.__place(p, occupied, planes, remaining & ~(1 << p), -1, -max(best_value, -1))
+                if value > best_value:
+                    best_value, best_piece = value, p
+                if best_value == 1:
+                    break
+        except SearchBudgetExceeded:
+            return (0 if best_value < -1 else best_value), best_piece, False
+        return best_value, best_piece, True
+
+    def __root_place(self, piece: int, occupied: int, planes: int, remaining: int, hint: tuple = None):
+        for cell_bit, killers in threats(occupied, planes):
+            if killers >> piece & 1:
+                return 1, (cell_of(cell_bit), None), True
+        if not remaining:
+            empty = ~occupied & 0xFFFF
+            return 0, (cell_of(empty & -empty), None), True
+
+        key, transform = self.__key(piece, occupied, planes)
+        entry = self.__table.get(key)
+        tt_move = None if entry is None else self.__from_table(entry[2], transform)
+        if hint is not None:
+            tt_move = hint
+        best_value, best_move = -2, None
+        alpha = -1
+        try:
+            for cell, new_occupied, new_planes, pieces in self.__moves(piece, occupied, planes, remaining, tt_move):
+                if not pieces:
+                    if best_value < -1:
+                        best_value, best_move = -1, (cell, cell_of(remaining & -remaining))
+                    continue
+                for p in pieces:
+                    value = -self.__place(p, new_occupied, new_planes, remaining & ~(1 << p), -1, -alpha)
+                    if value > best_value:
+                        best_value, best_move = value, (cell, p)
+                    alpha = max(alpha, value)
+                    if alpha >= 1:
+                        return best_value, best_move, True
+        except SearchBudgetExceeded:
+            if best_move is None:   # nothing was searched yet: take the first placement that looks safe
+                moves = self.__moves(piece, occupied, planes, remaining, tt_move)
+                cell, _, _, pieces = next((move for move in moves if move[3]), moves[0])
+                best_move = (cell, pieces[0] if pieces else cell_of(remaining & -remaining))
+            return (0 if best_value < -1 else best_value), best_move, False
+        return best_value, best_move, True
+
+    def __key(self, piece: int, occupied: int, planes: int):
+        if self.__canonical_empty is not None and 16 - occupied.bit_count() >= self.__canonical_empty:
+            key, transform = canonical_form(cells_of(occupied, planes), piece)
+            return -1 - key, transform  # negative, so that canonical keys never clash with raw keys
+        # the attribute planes and the occupancy mask identify every piece on the board
+        return planes | occupied << 64 | piece << 80, None
+
+    @staticmethod
+    def __to_table(move, transform):
+        # moves of canonical entries are stored in the canonical frame
+        if move is None or transform is None:
+            return move
+        return transform.cell(move[0]), transform.piece(move[1])
+
+    @staticmethod
+    def __from_table(move, transform):
+        if move is None or transform is None:
+            return move
+        return transform.inverse_cell(move[0]), transform.inverse_piece(move[1])
+
+    @staticmethod
+    def __moves(piece: int, occupied: int, planes: int, remaining: int, tt_move) -> list:
+        # (cell, new occupancy, new planes, pieces that can be given safely) for every placement. The stored best
+        # move comes first, then the placements that leave the opponent the fewest safe pieces
+        moves = []
+        empty = ~occupied & 0xFFFF
+        piece_planes = plane_bits[piece]
+        while empty:
+            cell_bit = empty & -empty
+            empty ^= cell_bit
+            cell = cell_of(cell_bit)
+            new_occupied = occupied | cell_bit
+            new_planes = planes | piece_planes[cell]
+            safe = remaining & ~killer_pieces(new_occupied, new_planes)
+            pieces = [p for p in range(16) if safe >> p & 1]
+            moves.append((len(pieces) if pieces else 16, cell, new_occupied, new_planes, pieces))
+        moves.sort(key=lambda move: (move[0], move[1]))
+        moves = [move[1:] for move in moves]
+
+        if tt_move is not None:
+            for i, move in enumerate(moves):
+                if move[0] == tt_move[0]:
+                    moves.insert(0, moves.pop(i))
+                    if tt_move[1] in move[3]:
+                        move[3].remove(tt_move[1])
+                        move[3].insert(0, tt_move[1])
+                    break
+        return moves
+
+    def __place(self, piece: int, occupied: int, planes: int, remaining: int, alpha: int, beta: int) -> int:
+        self.__count_node()
+        for _, killers in threats(occupied, planes):
+            if killers >> piece & 1:    # placing the piece wins right away
+                return 1
+        if not remaining:               # the last piece fills the board: draw
+            return 0
+
+        key, transform = self.__key(piece, occupied, planes)
+        entry = self.__table.get(key)
+        tt_move = None
+        alpha_orig = alpha
+        if entry is not None:
+            value, flag, tt_move = entry
+            tt_move = self.__from_table(tt_move, transform)
+            if flag == EXACT:
+                return value
+            if flag == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        best_value, best_move = -2, None
+        for cell, new_occupied, new_planes, pieces in self.__moves(piece, occupied, planes, remaining, tt_move):
+            if not pieces:  # every remaining piece lets the opponent win
+                if best_value < -1:
+                    best_value, best_move = -1, (cell, cell_of(remaining & -remaining))
+                continue
+            for p in pieces:
+                value = -self.__place(p, new_occupied, new_planes, remaining & ~(1 << p), -beta, -alpha)
+                if value > best_value:
+                    best_value, best_move = value, (cell, p)
+                if value > alpha:
+                    alpha = value
+                if alpha >= beta:
+                    break
+            if alpha >= beta:
+                break
+
+        if best_value <= alpha_orig:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.__table.store(key, best_value, flag, self.__to_table(best_move, transform))
+        return best_value
+
+
+def solve(game: Game, max_nodes: int = None, time_limit: float = None, solver: Solver = None,
+          hint=None) -> SolveResult:
+    solver = Solver() if solver is None else solver
+    return solver.solve(game, max_nodes, time_limit, hint)
@@ -0,0 +1,576 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from time import perf_counter, time
+from typing import NamedTuple
+
+from game import Game
+from game_index import GameIndex
+from journal import GameJournal, atomic_write
+
+# Persistence of active games, ratings (global and per guild), finished matches and the rating history.
+# Game changes are reported as events (log_new, log_select, log_place, log_message, log_end), so each backend can
+# store them in its own way. Saving is split in two: prepare_flush runs on the event loop and serializes only the
+# games and ratings that changed since the last flush, write_flush does the file or database I/O and is meant to
+# run in a thread executor, so button interactions never wait for the disk.
+
+
+class RatingsStore(dict):
+    # user_id -> {"wins", "losses", "elo", ...model state (see rating_models)}, remembering which players changed since
+    # the last flush. Assigning a player marks it; code updating the inner dicts in place must call mark_changed
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__changed = set()
+
+    def __setitem__(self, user_id: int, rating: dict):
+        super().__setitem__(user_id, rating)
+        self.__changed.add(user_id)
+
+    def add_player(self, user_id: int, rating: dict = None):
+        # rating is the new player's entry, by default an Elo of 1000 (see RatingModel.new_player)
+        if user_id not in self:
+            self[user_id] = rating if rating is not None else {"wins": 0, "losses": 0, "elo": 1000}
+
+    def mark_changed(self, *user_ids: int):
+        self.__changed.update(user_ids)
+
+    def pop_changed(self) -> set[int]:
+        changed, self.__changed = self.__changed, set()
+        return changed
+
+
+class GuildRatings(dict):
+    # guild_id -> RatingsStore of the games played in that guild, created on first use
+    def scope(self, guild_id: int) -> RatingsStore:
+        if guild_id not in self:
+            self[guild_id] = RatingsStore()
+        return self[guild_id]
+
+    def pop_changed(self) -> dict[int, set[int]]:
+        # guild_id -> players changed since the last flush
+        changed = {}
+        for guild_id, guild in self.items():
+            guild_changed = guild.pop_changed()
+            if guild_changed:
+                changed[guild_id] = guild_changed
+        return changed
+
+
+class FlushBatch(NamedTuple):
+    # what prepare_flush hands to write_flush, in a backend-specific layout
+    games: object
+    ratings: object
+    guild_ratings: object
+    matches: list
+    history: list
+
+
+class FlushMetrics:
+    def __init__(self):
+        self.flushes = 0
+        self.last_prepare = 0.0     # seconds spent on the event loop
+        self.last_write = 0.0       # seconds spent writing, off the event loop
+        self.max_write = 0.0
+        self.total_write = 0.0
+        self.last_bytes = 0
+        self.total_bytes = 0
+
+    def record(self, prepare: float, write: float, written: int):
+        self.flushes += 1
+        self.last_prepare = prepare
+        self.last_write = write
+        self.max_write = max(self.max_write, write)
+        self.total_write += write
+        self.last_bytes = written
+        self.total_bytes += written
+
+    def __str__(self):
+        return (f"flush #{self.flushes}: {self.last_bytes} bytes, prepared in {self.last_prepare * 1000:.1f}ms, "
+                f"written in {self.last_write * 1000:.1f}ms (max {self.max_write * 1000:.1f}ms, "
+                f"{self.total_bytes} bytes in total)")
+
+
+class Storage(ABC):
+    def __init__(self):
+        self.metrics = FlushMetrics()
+        self.__prepare_time = 0.0
+
+    @abstractmethod
+    def load_games(self) -> GameIndex:
+        ...
+
+    @abstractmethod
+    def load_ratings(self) -> RatingsStore:
+        ...
+
+    @abstractmethod
+    def load_guild_ratings(self) -> GuildRatings:
+        ...
+
+    @abstractmethod
+    def log_new(self, game: Game):
+        ...
+
+    @abstractmethod
+    def log_select(self, game: Game, piece_label: str):
+        ...
+
+    @abstractmethod
+    def log_place(self, game: Game, pos_x: int, pos_y: int):
+        ...
+
+    @abstractmethod
+    def log_message(self, game: Game):
+        ...
+
+    @abstractmethod
+    def log_end(self, game: Game):
+        ...
+
+    @abstractmethod
+    def record_match(self, game: Game, winner, victory_by: int, victory_code: int, guild_id: int = None,
+                     rated: bool = False):
+        ...
+
+    @abstractmethod
+    def load_matches(self) -> list[dict]:
+        # every recorded match (see match_record), oldest first
+        ...
+
+    @abstractmethod
+    def record_ratings(self, entries: list[dict]):
+        # appends to the rating history, written with the next flush (see history_entry)
+        ...
+
+    @abstractmethod
+    def load_history(self, user_id: int, guild_id: int = None) -> list[dict]:
+        # the history of one player in one scope (None for the global ratings), oldest first
+        ...
+
+    def prepare_flush(self, active_games: GameIndex, ratings: RatingsStore,
+                      guild_ratings: GuildRatings = None) -> FlushBatch:
+        start = perf_counter()
+        batch = self._prepare(active_games, ratings, guild_ratings if guild_ratings is not None else GuildRatings())
+        self.__prepare_time = perf_counter() - start
+        return batch
+
+    def write_flush(self, batch: FlushBatch) -> int:
+        start = perf_counter()
+        written = self._write(batch)
+        self.metrics.record(self.__prepare_time, perf_counter() - start, written)
+        return written
+
+    def flush(self, active_games: GameIndex, ratings: RatingsStore, guild_ratings: GuildRatings = None) -> int:
+        # both phases at once, for callers without an event loop
+        return self.write_flush(self.prepare_flush(active_games, ratings, guild_ratings))
+
+    @abstractmethod
+    def _prepare(self, active_games: GameIndex, ratings: RatingsStore, guild_ratings: GuildRatings) -> FlushBatch:
+        ...
+
+    @abstractmethod
+    def _write(self, batch: FlushBatch) -> int:
+        # returns the number of bytes written
+        ...
+
+    def close(self):
+        pass
+
+
+def match_record(game: Game, winner, victory_by: int, victory_code: int, guild_id: int = None,
+                 rated: bool = False) -> dict:
+    # winner is None for draws; rated tells whether the game changed the ratings (the history they are rebuilt from).
+    # started is 0 for games created before it was recorded
+    p1, p2 = game.get_players()
+    return {
+        "game_id": game.id, "player_1": p1, "player_2": p2, "winner": winner,
+        "victory_by": victory_by, "victory_code": victory_code, "started": game.started, "ended": time(),
+        "guild_id": guild_id, "rated": rated
+    }
+
+
+def history_entry(user_id: int, rating: dict, model: str, guild_id: int = None, period: int = 0) -> dict:
+    # rating of a player after a rating update, with the model state besides wins and losses
+    return {
+        "user_id": user_id, "guild_id": guild_id, "time": time(), "period": period, "model": model,
+        "elo": rating["elo"], "state": model_state(rating)
+    }
+
+
+def model_state(rating: dict) -> dict:
+    # the keys a rating model keeps besides wins, losses and elo (empty for Elo)
+    return {key: val for key, val in rating.items() if key not in ("wins", "losses", "elo")}
+
+
+class JsonStorage(Storage):
+    # games.json snapshot plus journal, ratings.json, guild_ratings.json ({guild: {user: rating}}), and matches and
+    # rating history appended to matches.jsonl and rating_history.jsonl.
+    # The encoded form of every game and rating is kept, so a flush only encodes again what changed
+    def __init__(self, games_path: str = "games.json", journal_path: str = "games.journal",
+                 ratings_path: str = "ratings.json", matches_path: str = "matches.jsonl", compact_after: int = 1000,
+                 guild_ratings_path: str = "guild_ratings.json", history_path: str = "rating_history.jsonl"):
+        super().__init__()
+        self.__journal = GameJournal(games_path, journal_path)
+        self.__ratings_path = ratings_path
+        self.__guild_ratings_path = guild_ratings_path
+        self.__matches_path = matches_path
+        self.__history_path = history_path
+        self.__compact_after = compact_after
+        self.__rating_strings = {}  # user_id -> '"user_id": {...}'
+        self.__guild_strings = {}   # guild_id -> {user_id: '"user_id": {...}'}
+        self.__guild_blocks = {}    # guild_id -> '"guild_id": {...}'
+        self.__matches = []
+        self.__history = []
+
+    def load_games(self) -> GameIndex:
+        return self.__journal.load()
+
+    def load_ratings(self) -> RatingsStore:
+        try:
+            with open(self.__ratings_path, "r") as ratings_json:
+                ratings = RatingsStore({int(key): val for key, val in json.load(ratings_json).items()})
+        except FileNotFoundError:
+            ratings = RatingsStore()
+        for user_id, rating in ratings.items():     # the file is rewritten from these, changed or not
+            self.__rating_strings[user_id] = f'"{user_id}": {json.dumps(rating)}'
+        return ratings
+
+    def load_guild_ratings(self) -> GuildRatings:
+        guild_ratings = GuildRatings()
+        try:
+            with open(self.__guild_ratings_path, "r") as guild_ratings_json:
+                for guild_id, guild in json.load(guild_ratings_json).items():
+                    guild_ratings[int(guild_id)] = RatingsStore({int(key): val for key, val in guild.items()})
+        except FileNotFoundError:
+            pass
+        # the file is rewritten from the encoded guilds, so all of them are encoded, changed or not
+        self.__encode_guilds(guild_ratings, {guild_id: guild.keys() for guild_id, guild in guild_ratings.items()})
+        return guild_ratings
+
+    def __encode_guilds(self, guild_ratings: GuildRatings, changed: dict[int, set[int]]):
+        for guild_id, user_ids in changed.items():
+            strings = self.__guild_strings.setdefault(guild_id, {})
+            guild = guild_ratings[guild_id]
+            for user_id in user_ids:
+                if user_id in guild:
+                    strings[user_id] = f'"{user_id}": {json.dumps(guild[user_id])}'
+            self.__guild_blocks[guild_id] = f'"{guild_id}": {{' + ", ".join(strings.values()) + "}"
+
+    def log_new(self, game: Game):
+        self.__journal.log_new(game)
+
+    def log_select(self, game: Game, piece_label: str):
+        self.__journal.log_select(game, piece_label)
+
+    def log_place(self, game: Game, pos_x: int, pos_y: int):
+        self.__journal.log_place(game, pos_x, pos_y)
+
+    def log_message(self, game: Game):
+        self.__journal.log_message(game)
+
+    def log_end(self, game: Game):
+        self.__journal.log_end(game)
+
+    def record_match(self, game: Game, winner, victory_by: int, victory_code: int, guild_id: int = None,
+                     rated: bool = False):
+        self.__matches.append(
+            json.dumps(match_record(game, winner, victory_by, victory_code, guild_id, rated)) + "\n"
+        )
+
+    @staticmethod
+    def __read_lines(path: str) -> list[dict]:
+        records = []
+        try:
+            with open(path, "r") as records_file:
+                for line in records_file:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:    # last record cut short by a crash
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def load_matches(self) -> list[dict]:
+        matches = self.__read_lines(self.__matches_path)
+        for match in matches:   # records written before these fields existed
+            match.setdefault("started", 0)
+            match.setdefault("guild_id", None)
+            match.setdefault("rated", match["winner"] is not None)
+        matches.sort(key=lambda m: m["ended"])
+        return matches
+
+    def record_ratings(self, entries: list[dict]):
+        self.__history.extend(json.dumps(entry) + "\n" for entry in entries)
+
+    def load_history(self, user_id: int, guild_id: int = None) -> list[dict]:
+        return [
+            entry for entry in self.__read_lines(self.__history_path)
+            if entry["user_id"] == user_id and entry["guild_id"] == guild_id
+        ]
+
+    def _prepare(self, active_games: GameIndex, ratings: RatingsStore, guild_ratings: GuildRatings) -> FlushBatch:
+        # moves are already in the journal: the snapshot is only rewritten now and then. The changed games are
+        # encoded anyway, so that they can be evicted once idle
+        active_games.pop_dirty()
+        snapshot = None
+        if self.__journal.records >= self.__compact_after:
+            seq = self.__journal.rotate()
+            if seq is not None:
+                snapshot = (seq, active_games.stored_games())
+
+        ratings_data = None
+        changed = ratings.pop_changed()
+        if changed:
+            for user_id in changed:
+                if user_id in ratings:
+                    self.__rating_strings[user_id] = f'"{user_id}": {json.dumps(ratings[user_id])}'
+            ratings_data = "{\n" + ",\n".join(self.__rating_strings.values()) + "\n}"
+
+        guild_data = None
+        guilds_changed = guild_ratings.pop_changed()
+        if guilds_changed:
+            self.__encode_guilds(guild_ratings, guilds_changed)
+            guild_data = "{\n" + ",\n".join(self.__guild_blocks.values()) + "\n}"
+
+        matches, self.__matches = self.__matches, []
+        history, self.__history = self.__history, []
+        return FlushBatch(snapshot, ratings_data, guild_data, matches, history)
+
+    def _write(self, batch: FlushBatch) -> int:
+        written = 0
+        if batch.games is not None:
+            written += self.__journal.write_snapshot(*batch.games)
+        for path, text in ((self.__ratings_path, batch.ratings), (self.__guild_ratings_path, batch.guild_ratings)):
+            if text is not None:
+                data = text.encode()
+                atomic_write(path, data)
+                written += len(data)
+        for path, lines in ((self.__matches_path, batch.matches), (self.__history_path, batch.history)):
+            if lines:
+                data = "".join(lines).encode()
+                with open(path, "ab") as lines_file:
+                    lines_file.write(data)
+                written += len(data)
+        return written
+
+
+class SQLiteStorage(Storage):
+    # games, ratings, matches and rating_history tables in WAL mode. The games stay in memory in active_games: each
+    # flush writes the dirty ones, the ended ones and the new matches and ratings in one transaction.
+    # The model state of a rating (see model_state) is stored as JSON in the state column, NULL for Elo
+    def __init__(self, path: str = "quarto.db"):
+        super().__init__()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        with self.__connection:
+            self.__connection.executescript("""
+                CREATE TABLE IF NOT EXISTS games (
+                    player_1 INTEGER NOT NULL,
+                    player_2 INTEGER NOT NULL,
+                    game BLOB NOT NULL,
+                    PRIMARY KEY (player_1, player_2)
+                );
+                CREATE TABLE IF NOT EXISTS ratings (
+                    user_id INTEGER PRIMARY KEY,
+                    elo INTEGER NOT NULL,
+                    wins INTEGER NOT NULL,
+                    losses INTEGER NOT NULL,
+                    state TEXT
+                );
+                CREATE TABLE IF NOT EXISTS guild_ratings (
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    elo INTEGER NOT NULL,
+                    wins INTEGER NOT NULL,
+                    losses INTEGER NOT NULL,
+                    state TEXT,
+                    PRIMARY KEY (guild_id, user_id)
+                );
+                CREATE TABLE IF NOT EXISTS matches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    game_id TEXT NOT NULL,
+                    player_1 INTEGER NOT NULL,
+                    player_2 INTEGER NOT NULL,
+                    winner INTEGER,
+                    victory_by INTEGER NOT NULL,
+                    victory_code INTEGER NOT NULL,
+                    started REAL NOT NULL DEFAULT 0,
+                    ended REAL NOT NULL,
+                    guild_id INTEGER,
+                    rated INTEGER NOT NULL DEFAULT 1
+                );
+                CREATE TABLE IF NOT EXISTS rating_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    guild_id INTEGER,
+                    time REAL NOT NULL,
+                    period INTEGER NOT NULL,
+                    model TEXT NOT NULL,
+                    elo INTEGER NOT NULL,
+                    state TEXT
+                );
+                CREATE INDEX IF NOT EXISTS rating_history_user ON rating_history (user_id, guild_id);
+                CREATE INDEX IF NOT EXISTS matches_player_1 ON matches (player_1);
+                CREATE INDEX IF NOT EXISTS matches_player_2 ON matches (player_2);
+            """)
+            for table, column, definition in (
+                    ("matches", "started", "REAL NOT NULL DEFAULT 0"), ("matches", "guild_id", "INTEGER"),
+                    ("matches", "rated", "INTEGER NOT NULL DEFAULT 1"), ("ratings", "state", "TEXT"),
+                    ("guild_ratings", "state", "TEXT")):
+                columns = {row[1] for row in self.__connection.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:   # databases created before the column existed
+                    self.__connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS matches_ended ON matches (ended)")
+        self.__ended = set()        # (player_1, player_2) to delete
+        self.__matches = []
+        self.__history = []
+
+    @property
+    def connection(self):
+        return self.__connection
+
+    def load_games(self) -> GameIndex:
+        # rows written by older versions hold the string form, which from_bytes also reads
+        active_games = GameIndex(Game.from_bytes, Game.to_bytes, Game.id_from_bytes)
+        for p1, p2, game_data in self.__connection.execute("SELECT player_1, player_2, game FROM games"):
+            active_games.load_stored(p1, p2, game_data)
+        return active_games
+
+    def load_ratings(self) -> RatingsStore:
+        ratings = RatingsStore({
+            user_id: {"wins": wins, "losses": losses, "elo": elo} | (json.loads(state) if state else {})
+            for user_id, elo, wins, losses, state in self.__connection.execute(
+                "SELECT user_id, elo, wins, losses, state FROM ratings"
+            )
+        })
+        ratings.pop_changed()
+        return ratings
+
+    def load_guild_ratings(self) -> GuildRatings:
+        guild_ratings = GuildRatings()
+        for guild_id, user_id, elo, wins, losses, state in self.__connection.execute(
+                "SELECT guild_id, user_id, elo, wins, losses, state FROM guild_ratings"):
+            guild_ratings.scope(guild_id)[user_id] = ({"wins": wins, "losses": losses, "elo": elo}
+                                                      | (json.loads(state) if state else {}))
+        guild_ratings.pop_changed()
+        return guild_ratings
+
+    # the games mark themselves as dirty
+    def log_new(self, game: Game):
+        self.__ended.discard(game.get_players())
+
+    def log_select(self, game: Game, piece_label: str):
+        pass
+
+    def log_place(self, game: Game, pos_x: int, pos_y: int):
+        pass
+
+    def log_message(self, game: Game):
+        pass
+
+    def log_end(self, game: Game):
+        self.__ended.add(game.get_players())
+
+    def record_match(self, game: Game, winner, victory_by: int, victory_code: int, guild_id: int = None,
+                     rated: bool = False):
+        self.__matches.append(match_record(game, winner, victory_by, victory_code, guild_id, rated))
+
+    def load_matches(self) -> list[dict]:
+        columns = ("game_id", "player_1", "player_2", "winner", "victory_by", "victory_code", "started", "ended",
+                   "guild_id", "rated")
+        return [
+            dict(zip(columns, row)) | {"rated": bool(row[-1]) and row[3] is not None}
+            for row in self.__connection.execute(
+                f"SELECT {', '.join(columns)} FROM matches ORDER BY ended, id"
+            )
+        ]
+
+    def record_ratings(self, entries: list[dict]):
+        self.__history.extend(entry | {"state": json.dumps(entry["state"]) if entry["state"] else None}
+                              for entry in entries)
+
+    def load_history(self, user_id: int, guild_id: int = None) -> list[dict]:
+        columns = ("user_id", "guild_id", "time", "period", "model", "elo", "state")
+        return [
+            dict(zip(columns, row)) | {"state": json.loads(row[-1]) if row[-1] else {}}
+            for row in self.__connection.execute(
+                f"SELECT {', '.join(columns)} FROM rating_history WHERE user_id = ? AND guild_id IS ? ORDER BY id",
+                (user_id, guild_id)
+            )
+        ]
+
+    @staticmethod
+    def __state_column(rating: dict) -> str:
+        state = model_state(rating)
+        return json.dumps(state) if state else None
+
+    def _prepare(self, active_games: GameIndex, ratings: RatingsStore, guild_ratings: GuildRatings) -> FlushBatch:
+        games = active_games.pop_dirty()
+        ended, self.__ended = list(self.__ended), set()
+        rows = [
+            (user_id, ratings[user_id]["elo"], ratings[user_id]["wins"], ratings[user_id]["losses"],
+             self.__state_column(ratings[user_id]))
+            for user_id in ratings.pop_changed() if user_id in ratings
+        ]
+        guild_rows = []
+        for guild_id, user_ids in guild_ratings.pop_changed().items():
+            guild = guild_ratings[guild_id]
+            guild_rows.extend(
+                (guild_id, user_id, guild[user_id]["elo"], guild[user_id]["wins"], guild[user_id]["losses"],
+                 self.__state_column(guild[user_id]))
+                for user_id in user_ids if user_id in guild
+            )
+        matches, self.__matches = self.__matches, []
+        history, self.__history = self.__history, []
+        return FlushBatch((games, ended), rows, guild_rows, matches, history)
+
+    def _write(self, batch: FlushBatch) -> int:
+        games, ended = batch.games
+        with self.__connection:
+            self.__connection.executemany("DELETE FROM games WHERE player_1 = ? AND player_2 = ?", ended)
+            self.__connection.executemany(
+                "INSERT INTO games (player_1, player_2, game) VALUES (?, ?, ?) "
+                "ON CONFLICT (player_1, player_2) DO UPDATE SET game = excluded.game",
+                games
+            )
+            self.__connection.executemany(
+                "INSERT INTO ratings (user_id, elo, wins, losses, state) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE "
+                "SET elo = excluded.elo, wins = excluded.wins, losses = excluded.losses, state = excluded.state",
+                batch.ratings
+            )
+            self.__connection.executemany(
+                "INSERT INTO guild_ratings (guild_id, user_id, elo, wins, losses, state) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, user_id) DO UPDATE "
+                "SET elo = excluded.elo, wins = excluded.wins, losses = excluded.losses, state = excluded.state",
+                batch.guild_ratings
+            )
+            self.__connection.executemany(
+                "INSERT INTO matches (game_id, player_1, player_2, winner, victory_by, victory_code, started, ended, "
+                "guild_id, rated) VALUES (:game_id, :player_1, :player_2, :winner, :victory_by, :victory_code, "
+                ":started, :ended, :guild_id, :rated)",
+                batch.matches
+            )
+            self.__connection.executemany(
+                "INSERT INTO rating_history (user_id, guild_id, time, period, model, elo, state) "
+                "VALUES (:user_id, :guild_id, :time, :period, :model, :elo, :state)",
+                batch.history
+            )
+        # size of the rows written, not counting SQLite's own pages
+        return (sum(len(game_data) for _, _, game_data in games)
+                + sum(len(str(row)) for rows in (ended, batch.ratings, batch.guild_ratings, batch.matches,
+                                                 batch.history)
+                      for row in rows))
+
+    def close(self):
+        self.__connection.close()
+
+
+def open_storage(kind: str = "json", path: str = None) -> Storage:
+    if kind == "sqlite":
+        return SQLiteStorage(path or "quarto.db")
+    if kind == "json":
+        return JsonStorage()
+    raise Exception(f"Unknown storage backend {kind}")
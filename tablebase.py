@@ -0,0 +1,254 @@
+import argparse
+import mmap
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from random import Random
+
+from bitboard import plane_bits
+from canonical import canonical_form, key_digest
+from game import piece_indices, piece_labels
+from solver import Solver, killer_pieces, threats
+
+# Opening books and endgame tablebases share one file format: a 16-byte header followed by an open-addressing
+# hash table of 16-byte slots, looked up through mmap without loading the file in memory.
+# Entries describe placement positions (a piece to place) in their canonical form: the value is 1/0/-1 for the
+# player who places, and the move (cell to place on, piece to give) is stored in the canonical frame.
+# A slot matches a position when both its hash and its check (the two halves of the canonical key's digest) do, so a
+# hash collision reads as a missing entry rather than as the move of another position. QTB1 files had no check and
+# are rebuilt.
+
+MAGIC = b"QTB2"
+header_format = struct.Struct("<4sII4x")    # magic, number of slots (a power of 2), number of entries
+entry_format = struct.Struct("<QbBBBI")     # position hash (0 = empty slot), value, cell, next piece, flags, check
+NO_MOVE = 255
+COMPLETE = 1                                # flag: the value was proven, not just the best found within the budget
+
+
+def canonical_position(cells: list[int], piece: int):
+    # ((hash, check), canonical cells, canonical piece, transform)
+    key, transform = canonical_form(cells, piece)
+    canonical_cells = [-1] * 16
+    for cell, p in enumerate(cells):
+        if p >= 0:
+            canonical_cells[transform.cell(cell)] = transform.piece(p)
+    position_hash, check = key_digest(key)
+    return (position_hash or 1, check), canonical_cells, transform.piece(piece), transform
+
+
+def write_table(path: str, records: dict[tuple[int, int], tuple[int, int, int, int]]):
+    # records: (hash, check) -> (value, cell, next piece, flags). Written to a temporary file, then renamed
+    slots = 16
+    while slots < 2 * len(records):
+        slots *= 2
+    table = bytearray(header_format.size + slots * entry_format.size)
+    header_format.pack_into(table, 0, MAGIC, slots, len(records))
+    used = bytearray(slots)
+    for (position_hash, check), (value, cell, next_piece, flags) in records.items():
+        slot = position_hash & (slots - 1)
+        while used[slot]:
+            slot = (slot + 1) & (slots - 1)
+        used[slot] = 1
+        entry_format.pack_into(
+            table, header_format.size + slot * entry_format.size, position_hash, value, cell, next_piece, flags, check
+        )
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as table_file:
+        table_file.write(table)
+    os.replace(temp_path, path)
+
+
+class TablebaseFile:
+    def __init__(self, path: str):
+        self.__file = open(path, "rb")
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.__slots, self.__entries = header_format.unpack_from(self.__map, 0)
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a tablebase file of this version, build it again with tablebase.py")
+
+    @property
+    def entries(self):
+        return self.__entries
+
+    def __len__(self):
+        return self.__entries
+
+    def probe(self, position_id: tuple[int, int]):
+        position_hash, check = position_id
+        slot = position_hash & (self.__slots - 1)
+        while True:
+            stored_hash, value, cell, next_piece, flags, stored_check = entry_format.unpack_from(
+                self.__map, header_format.size + slot * entry_format.size
+            )
+            if stored_hash == position_hash and stored_check == check:
+                return value, cell, next_piece, flags
+            if stored_hash == 0:
+                return None
+            slot = (slot + 1) & (self.__slots - 1)
+
+    def lookup(self, cells: list[int], piece: int):
+        # (value, cell, next piece, complete) in the frame of the given position, or None if it is not stored
+        position_id, _, _, transform = canonical_position(cells, piece)
+        entry = self.probe(position_id)
+        if entry is None:
+            return None
+        value, cell, next_piece, flags = entry
+        cell = None if cell == NO_MOVE else transform.inverse_cell(cell)
+        next_piece = None if next_piece == NO_MOVE else transform.inverse_piece(next_piece)
+        return value, cell, next_piece, bool(flags & COMPLETE)
+
+    def lookup_game(self, game):
+        if game.stage != 2:
+            return None
+        return self.lookup(game.board.to_cells(), piece_indices[game.last_selected_piece.code])
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+
+def children(cells: list[int], piece: int):
+    # placement positions reachable by placing the piece without winning and giving any remaining piece
+    occupied = planes = used = 0
+    for cell, p in enumerate(cells):
+        if p >= 0:
+            occupied |= 1 << cell
+            planes |= plane_bits[p][cell]
+            used |= 1 << p
+    if any(killers >> piece & 1 for _, killers in threats(occupied, planes)):
+        return
+    remaining = 0xFFFF & ~used & ~(1 << piece)
+    for cell in range(16):
+        if not occupied >> cell & 1:
+            new_cells = list(cells)
+            new_cells[cell] = piece
+            for next_piece in range(16):
+                if remaining >> next_piece & 1:
+                    yield new_cells, next_piece
+
+
+def opening_positions(plies: int) -> list[tuple[list[int], int]]:
+    # every canonical placement position with fewer than "plies" pieces on the board
+    positions = {}
+    frontier = {}
+    position_id, canonical_cells, canonical_piece, _ = canonical_position([-1] * 16, 0)
+    frontier[position_id] = (canonical_cells, canonical_piece)
+    for _ in range(plies):
+        positions.update(frontier)
+        next_frontier = {}
+        for cells, piece in frontier.values():
+            for new_cells, next_piece in children(cells, piece):
+                position_id, canonical_cells, canonical_piece, _ = canonical_position(new_cells, next_piece)
+                if position_id not in positions:
+                    next_frontier[position_id] = (canonical_cells, canonical_piece)
+        frontier = next_frontier
+    return list(positions.values())
+
+
+def endgame_positions(max_empty: int, samples: int, seed: int = 0) -> list[tuple[list[int], int]]:
+    # enumerating every position with few empty cells is out of reach, so they are collected from random games
+    # where nobody hands over a winning piece, which is how real endgames look like
+    rng = Random(seed)
+    positions = {}
+    for _ in range(samples):
+        occupied = planes = 0
+        cells = [-1] * 16
+        remaining = 0xFFFF
+        piece = rng.randrange(16)
+        remaining &= ~(1 << piece)
+        while True:
+            empty = [c for c in range(16) if cells[c] < 0]
+            if len(empty) <= max_empty:
+                position_id, canonical_cells, canonical_piece, _ = canonical_position(cells, piece)
+                positions[position_id] = (canonical_cells, canonical_piece)
+            if any(killers >> piece & 1 for _, killers in threats(occupied, planes)) or not remaining:
+                break
+            cell = rng.choice(empty)
+            cells[cell] = piece
+            occupied |= 1 << cell
+            planes |= plane_bits[piece][cell]
+            safe = remaining & ~killer_pieces(occupied, planes)
+            choices = [p for p in range(16) if (safe or remaining) >> p & 1]
+            piece = rng.choice(choices)
+            remaining &= ~(1 << piece)
+    return list(positions.values())
+
+
+_solver = None
+
+
+def solve_chunk(positions: list[tuple[list[int], int]], max_nodes: int = None, time_limit: float = None):
+    # worker entry point: positions are canonical, so the moves come out in the canonical frame
+    global _solver
+    if _solver is None:
+        _solver = Solver()
+    records = []
+    for cells, piece in positions:
+        result = _solver.solve_position(cells, piece, max_nodes=max_nodes, time_limit=time_limit)
+        cell = NO_MOVE if result.cell is None else 4 * result.cell[0] + result.cell[1]
+        next_piece = NO_MOVE if result.piece is None else piece_labels.index(result.piece)
+        position_hash, check = canonical_position(cells, piece)[0]
+        records.append((position_hash, result.value, cell, next_piece, COMPLETE if result.complete else 0, check))
+    return records
+
+
+def read_progress(path: str) -> dict[tuple[int, int], tuple[int, int, int, int]]:
+    records = {}
+    try:
+        with open(path, "rb") as progress_file:
+            data = progress_file.read()
+    except FileNotFoundError:
+        return records
+    usable = len(data) - len(data) % entry_format.size    # a crash may have left a partial record at the end
+    for position_hash, value, cell, next_piece, flags, check in entry_format.iter_unpack(data[:usable]):
+        records[(position_hash, check)] = (value, cell, next_piece, flags)
+    return records
+
+
+def generate(positions, output: str, workers: int = None, chunk_size: int = 64,
+             max_nodes: int = None, time_limit: float = None):
+    # solved records are appended to "<output>.part" as they come, so an interrupted run resumes where it stopped
+    progress_path = output + ".part"
+    records = read_progress(progress_path)
+    pending = [(cells, piece) for cells, piece in positions if canonical_position(cells, piece)[0] not in records]
+    print(f"{len(positions)} positions, {len(records)} already solved, {len(pending)} to go.")
+
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    with open(progress_path, "ab") as progress_file, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(solve_chunk, chunk, max_nodes, time_limit) for chunk in chunks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            for position_hash, value, cell, next_piece, flags, check in future.result():
+                records[(position_hash, check)] = (value, cell, next_piece, flags)
+                progress_file.write(entry_format.pack(position_hash, value, cell, next_piece, flags, check))
+            progress_file.flush()
+            print(f"chunk {done}/{len(chunks)} solved.")
+
+    write_table(output, records)
+    os.remove(progress_path)
+    print(f"'{output}' written with {len(records)} entries.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build Quarto opening books and endgame tablebases.")
+    parser.add_argument("kind", choices=["book", "endgame"])
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--plies", type=int, default=2, help="book: positions with fewer pieces on the board")
+    parser.add_argument("--empty", type=int, default=6, help="endgame: maximum number of empty cells")
+    parser.add_argument("--samples", type=int, default=10000, help="endgame: random games to collect positions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-nodes", type=int, default=200000,
+                        help="search budget per position, 0 for none (positions with few pieces never finish then); "
+                             "entries out of budget keep the best move found, which the AI searches first")
+    parser.add_argument("--time-limit", type=float, default=None, help="seconds per position")
+    args = parser.parse_args()
+
+    if args.kind == "book":
+        positions = opening_positions(args.plies)
+    else:
+        positions = endgame_positions(args.empty, args.samples, args.seed)
+    generate(positions, args.output, args.workers, max_nodes=args.max_nodes or None, time_limit=args.time_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from outbound import OutboundScheduler  # noqa: E402
+
+
+class FakeDiscord:
+    # stands in for the Discord HTTP API: records the calls in the order they are sent, and makes each one take
+    # `latency` seconds, or `rate_limit` seconds for the calls matching `limited` (a channel sleeping on its bucket)
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0, limited=lambda name: False):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.limited = limited
+        self.calls = []
+
+    def call(self, name: str, result=None, error: Exception = None):
+        # a zero-argument coroutine function, like lambda: message.edit(view=view)
+        async def action():
+            await asyncio.sleep(self.rate_limit if self.limited(name) else self.latency)
+            self.calls.append(name)
+            if error is not None:
+                raise error
+            return name if result is None else result
+        return action
+
+    async def sender(self, request):
+        return await request.action()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_edits_of_a_message_are_coalesced():
+    async def scenario():
+        fake = FakeDiscord(latency=0.01)
+        outbound = OutboundScheduler(fake.sender)
+        first = outbound.send(1, fake.call("send"))     # in flight while the edits are queued
+        edits = [outbound.edit(1, 10, fake.call(f"edit {n}")) for n in range(3)]
+        results = await asyncio.gather(first, *edits)
+        return fake, outbound, results
+
+    fake, outbound, results = run(scenario())
+    assert fake.calls == ["send", "edit 2"]
+    assert results == ["send", "edit 2", "edit 2", "edit 2"]
+    assert outbound.metrics.coalesced == 2
+    assert outbound.metrics.sent == 2
+    assert outbound.depth() == 0 and outbound.channels() == 0
+
+
+def test_messages_go_before_edits_in_order():
+    async def scenario():
+        fake = FakeDiscord(latency=0.01)
+        outbound = OutboundScheduler(fake.sender)
+        futures = [
+            outbound.send(1, fake.call("send 1")),
+            outbound.edit(1, 10, fake.call("edit 10")),
+            outbound.edit(1, 11, fake.call("edit 11")),
+            outbound.send(1, fake.call("send 2")),
+            outbound.send(2, fake.call("other channel")),
+        ]
+        await asyncio.gather(*futures)
+        return fake
+
+    fake = run(scenario())
+    channel_1 = [call for call in fake.calls if call != "other channel"]
+    assert channel_1 == ["send 1", "send 2", "edit 10", "edit 11"]
+    assert fake.calls.index("other channel") < fake.calls.index("send 2")    # channels do not wait for each other
+
+
+def test_responses_do_not_wait_for_a_rate_limited_call():
+    async def scenario():
+        fake = FakeDiscord(latency=0.01, rate_limit=1.0, limited=lambda name: name.startswith("edit"))
+        outbound = OutboundScheduler(fake.sender)
+        edit = outbound.edit(1, 10, fake.call("edit"))
+        await asyncio.sleep(0.01)   # the edit is in flight, sleeping on the rate limit
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await outbound.respond(1, fake.call("response"))
+        elapsed = loop.time() - start
+        await outbound.close()
+        return fake, edit, elapsed
+
+    fake, edit, elapsed = run(scenario())
+    assert fake.calls == ["response"]
+    assert elapsed < 0.5
+    assert edit.cancelled()
+
+
+def test_close_cancels_what_was_not_sent():
+    async def scenario():
+        fake = FakeDiscord(latency=0.05)
+        outbound = OutboundScheduler(fake.sender)
+        sent = outbound.send(1, fake.call("send"))
+        queued = [outbound.send(1, fake.call("queued send")), outbound.edit(1, 10, fake.call("queued edit"))]
+        await sent
+        await outbound.close()
+        return fake, outbound, queued
+
+    fake, outbound, queued = run(scenario())
+    assert fake.calls == ["send"]
+    assert all(future.cancelled() for future in queued)
+    assert outbound.depth() == 0 and outbound.channels() == 0
+
+
+def test_failures_reach_the_caller_and_do_not_stop_the_queue():
+    async def scenario():
+        fake = FakeDiscord()
+        outbound = OutboundScheduler(fake.sender)
+        failing = outbound.send(1, fake.call("failing", error=RuntimeError("404 Not Found")))
+        following = outbound.send(1, fake.call("following"))
+        results = await asyncio.gather(failing, following, return_exceptions=True)
+        return outbound, results
+
+    outbound, (error, result) = run(scenario())
+    assert isinstance(error, RuntimeError)
+    assert result == "following"
+    assert outbound.metrics.failed == 1 and outbound.metrics.sent == 1
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from storage import JsonStorage  # noqa: E402
+
+
+def json_storage(directory) -> JsonStorage:
+    return JsonStorage(
+        games_path=str(directory / "games.json"), journal_path=str(directory / "games.journal"),
+        ratings_path=str(directory / "ratings.json"), matches_path=str(directory / "matches.jsonl"),
+        guild_ratings_path=str(directory / "guild_ratings.json"), history_path=str(directory / "rating_history.jsonl")
+    )
+
+
+def reload(directory):
+    storage = json_storage(directory)
+    active_games = storage.load_games()
+    return storage, active_games, storage.load_ratings(), storage.load_guild_ratings()
+
+
+def test_flush_keeps_the_ratings_loaded_at_startup(tmp_path):
+    storage, active_games, ratings, guild_ratings = reload(tmp_path)
+    for user_id in (1, 2, 3):
+        ratings.add_player(user_id)
+    storage.flush(active_games, ratings, guild_ratings)
+    storage.close()
+
+    storage, active_games, ratings, guild_ratings = reload(tmp_path)
+    ratings[2] = {"wins": 1, "losses": 0, "elo": 1016}
+    ratings.add_player(4)
+    storage.flush(active_games, ratings, guild_ratings)
+    storage.close()
+
+    _, _, ratings, _ = reload(tmp_path)
+    assert sorted(ratings) == [1, 2, 3, 4]
+    assert ratings[2]["elo"] == 1016 and ratings[1]["elo"] == 1000
+
+
+def test_flush_keeps_the_guild_ratings_loaded_at_startup(tmp_path):
+    storage, active_games, ratings, guild_ratings = reload(tmp_path)
+    for guild_id in (10, 20):
+        for user_id in (1, 2):
+            guild_ratings.scope(guild_id).add_player(user_id)
+    storage.flush(active_games, ratings, guild_ratings)
+    storage.close()
+
+    storage, active_games, ratings, guild_ratings = reload(tmp_path)
+    guild_ratings.scope(10)[1] = {"wins": 1, "losses": 0, "elo": 1016}
+    storage.flush(active_games, ratings, guild_ratings)
+    storage.close()
+
+    _, _, _, guild_ratings = reload(tmp_path)
+    assert sorted(guild_ratings) == [10, 20]
+    assert sorted(guild_ratings[10]) == [1, 2] and sorted(guild_ratings[20]) == [1, 2]
+    assert guild_ratings[10][1]["elo"] == 1016
@@ -0,0 +1,55 @@
+# Table-driven win detection.
+# Pieces are handled as 4-bit indices (see game.piece_indices): each bit is one attribute of the piece, so four
+# pieces share an attribute when that bit is set in all of them (AND) or cleared in all of them (OR).
+# Cells are numbered 4 * x + y; empty cells hold -1.
+
+rows = [tuple(4 * x + y for y in range(4)) for x in range(4)]
+cols = [tuple(4 * x + y for x in range(4)) for y in range(4)]
+diags = [(0, 5, 10, 15), (3, 6, 9, 12)]
+
+lines = rows + cols + diags
+line_types = [1, 1, 1, 1, 2, 2, 2, 2, 3, 4]     # victory_by code of each line: 1 row, 2 col, 3 d1, 4 d2
+line_masks = [sum(1 << cell for cell in line) for line in lines]
+cell_lines = [[i for i, line in enumerate(lines) if cell in line] for cell in range(16)]
+
+
+def _win_code(ones: int, zeros: int) -> int:
+    # priority of the attributes: light, dark, round, square, tall, short, full, hollow
+    for b in (3, 2, 1, 0):
+        if zeros >> b & 1:
+            return 7 - 2 * b
+        if ones >> b & 1:
+            return 8 - 2 * b
+    return 0
+
+
+# indexed by (ones << 4) | zeros, where ones/zeros are the attribute bits set/cleared in every piece of the line
+win_codes = [_win_code(i >> 4, i & 0xF) for i in range(256)]
+
+
+def line_code(a: int, b: int, c: int, d: int) -> int:
+    return win_codes[(a & b & c & d) << 4 | (~(a | b | c | d) & 0xF)]
+
+
+def check_cells(cells: list[int], cell: int) -> (int, int):
+    # victory through the last placed cell, with the (victory_by, victory_code) contract of Board.check_victory
+    for i in cell_lines[cell]:
+        a, b, c, d = [cells[j] for j in lines[i]]
+        if a < 0 or b < 0 or c < 0 or d < 0:
+            continue
+        code = line_code(a, b, c, d)
+        if code > 0:
+            return line_types[i], code
+    return 0, 0
+
+
+def check_board(cells: list[int]) -> (int, int):
+    # victory anywhere on the board, checking rows, then cols, then diagonals
+    for i, (w, x, y, z) in enumerate(lines):
+        a, b, c, d = cells[w], cells[x], cells[y], cells[z]
+        if a < 0 or b < 0 or c < 0 or d < 0:
+            continue
+        code = line_code(a, b, c, d)
+        if code > 0:
+            return line_types[i], code
+    return 0, 0